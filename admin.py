@@ -0,0 +1,21 @@
+import hmac
+from functools import wraps
+
+from flask import abort, current_app, request
+
+
+def is_admin():
+    # admin pages are off unless ADMIN_TOKEN is configured; the token is sent
+    # in the X-Admin-Token header
+    token = current_app.config.get('ADMIN_TOKEN')
+    given = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(given, token)
+
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
@@ -3,6 +3,9 @@
 #----------------------------------------------------------------------------#
 
 import json
+import os
+import time
+import click
 import dateutil.parser
 import babel
 from flask import Flask, render_template, request, Response, flash, redirect, url_for
@@ -13,8 +16,24 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 from datetime import datetime
-from models import db, Venue, Artist, Show
+from models import db, Venue, Artist, Show, ShowArchive, ShowSeries
+import archive
+import bookings
+import rollups
+import sharding
+import snapshot
+from ratelimit import limiter
+from conditional import conditional, latest
+import images
+from profiler import profiler
+from metrics import metrics
+from recommend import recommender
+from matching import matcher
+from changelog import feed
+from sqlalchemy import case, func
+from sqlalchemy.orm.exc import StaleDataError
 from flask_migrate import Migrate
+from jinja2 import FileSystemBytecodeCache
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -27,6 +46,18 @@ db.app = app
 db.init_app(app)
 
 Migrate(app, db)
+archive.init_app(app)
+bookings.init_app(app)
+rollups.init_app(app)
+sharding.init_app(app)
+limiter.init_app(app)
+images.init_app(app)
+profiler.init_app(app)
+metrics.init_app(app)
+recommender.init_app(app)
+matcher.init_app(app)
+feed.init_app(app)
+snapshot.init_app(app)
 
 # TODO: connect to a local postgresql database
 
@@ -38,6 +69,108 @@ def get_current_time():
   # return datetime.now().strftime('%Y-%m-%d %H:%M:%S:%f')
   return str(datetime.now())
 
+def get_past_shows(owner, current_time):
+  # past shows of a venue or artist, including the ones already moved to
+  # the archive table by `flask archive-shows`
+  past_shows = owner.shows.filter(Show.start_time < current_time).all()
+  past_shows += owner.archived_shows.all()
+  return sorted(past_shows, key=lambda show: show.start_time)
+
+def named(model, ids):
+  # [{'id', 'name', 'image_link'}] for `ids`, in the order given
+  if not ids:
+    return []
+  rows = db.session.query(model.id, model.name, model.image_link).filter(
+      model.id.in_(ids)).all()
+  found = dict((row.id, {'id': row.id, 'name': row.name,
+      'image_link': row.image_link}) for row in rows)
+  return [found[id] for id in ids if id in found]
+
+def upcoming_count(current_time):
+  return func.sum(case((Show.start_time > current_time, 1), else_=0))
+
+def venue_rows(session, current_time, search=None):
+  # (id, name, city, state, number of upcoming shows) for every venue, or
+  # for the ones whose name matches `search`; runs once per shard
+  query = session.query(Venue.id, Venue.name, Venue.city, Venue.state,
+      upcoming_count(current_time)).outerjoin(Venue.shows)
+  if search is not None:
+    query = query.filter(Venue.name.ilike('%'+search+'%'))
+  return query.group_by(Venue.id, Venue.name, Venue.city, Venue.state).all()
+
+def artist_rows(session, search):
+  return session.query(Artist.id, Artist.name).filter(
+      Artist.name.ilike('%'+search+'%')).all()
+
+def artist_upcoming_counts(session, artist_ids, current_time):
+  # an artist's shows live on the shards of the venues they play at
+  return session.query(Show.artist_id, func.count(Show.id)).filter(
+      Show.artist_id.in_(artist_ids), Show.start_time > current_time
+      ).group_by(Show.artist_id).all()
+
+#----------------------------------------------------------------------------#
+# Validators.
+#----------------------------------------------------------------------------#
+
+# Everything a page depends on, read with aggregate queries only, so that a
+# revalidation request can be answered with a 304 without loading the page's
+# rows or rendering its template. Rows are summed up in Python because a
+# sharded session returns one aggregate row per shard.
+
+def table_state(model):
+  rows = db.session.query(func.max(model.updated_at), func.count(model.id)).all()
+  return latest(*[row[0] for row in rows]), sum(row[1] for row in rows)
+
+def page_validators(model, entity_id, owner_key, related_model, related_key):
+  # a venue or artist page: the entity, its live and archived shows, and the
+  # artists/venues those shows link to
+  entity = db.session.query(model.id, model.updated_at).filter(
+      model.id == entity_id).all()
+  if not entity:
+    return None
+  current_time = get_current_time()
+  shows = db.session.query(getattr(Show, related_key), func.max(Show.updated_at),
+      func.count(Show.id), upcoming_count(current_time)).filter(
+      getattr(Show, owner_key) == entity_id).group_by(
+      getattr(Show, related_key)).all()
+  archived = db.session.query(getattr(ShowArchive, related_key),
+      func.count(ShowArchive.id)).filter(
+      getattr(ShowArchive, owner_key) == entity_id).group_by(
+      getattr(ShowArchive, related_key)).all()
+  related_ids = set(row[0] for row in shows) | set(row[0] for row in archived)
+  related_updated = None
+  if related_ids:
+    related_updated = latest(*[row[0] for row in db.session.query(
+        func.max(related_model.updated_at)).filter(
+        related_model.id.in_(related_ids)).all()])
+  last_modified = latest(entity[0].updated_at, related_updated,
+      *[row[1] for row in shows])
+  parts = [model.__name__, entity_id, last_modified,
+      sorted((row[0], row[2], row[3] or 0) for row in shows), sorted(archived)]
+  return parts, last_modified
+
+def venue_validators(venue_id):
+  found = page_validators(Venue, venue_id, 'venue_id', Artist, 'artist_id')
+  if found:
+    found[0].append(recommender.for_venue(venue_id))
+  return found
+
+def artist_validators(artist_id):
+  found = page_validators(Artist, artist_id, 'artist_id', Venue, 'venue_id')
+  if found:
+    found[0].append(recommender.for_artist(artist_id))
+  return found
+
+def artists_validators():
+  updated, count = table_state(Artist)
+  return ['artists', updated, count], updated
+
+def shows_validators():
+  parts = ['shows']
+  for model in (Show, Artist, Venue):
+    parts.extend(table_state(model))
+  return parts, latest(*parts[1::2])
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
@@ -52,6 +185,36 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+#----------------------------------------------------------------------------#
+# Templates.
+#----------------------------------------------------------------------------#
+
+if app.config.get('JINJA_BYTECODE_CACHE_DIR'):
+  os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+    app.config['JINJA_BYTECODE_CACHE_DIR'])
+
+def warm_templates():
+  # compiles every page, form and layout template so a fresh worker does not
+  # pay for it on its first requests. Returns {template name: seconds}.
+  timings = {}
+  for name in app.jinja_env.list_templates(extensions=['html']):
+    started = time.perf_counter()
+    app.jinja_env.get_template(name)
+    timings[name] = time.perf_counter() - started
+    app.logger.info('Compiled template %s in %.1fms', name, timings[name] * 1000)
+  # the first babel call loads the locale data from disk
+  format_datetime(get_current_time(), 'full')
+  return timings
+
+@app.cli.command('warm-templates')
+def warm_templates_command():
+  """Compile all templates and report how long each one took."""
+  timings = warm_templates()
+  for name in sorted(timings, key=timings.get, reverse=True):
+    click.echo('%8.1fms  %s' % (timings[name] * 1000, name))
+  click.echo('%8.1fms  total' % (sum(timings.values()) * 1000))
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
@@ -69,43 +232,39 @@ def venues():
   # DONE: replace with real venues data.
   #       num_upcoming_shows should be aggregated based on number of upcoming shows per venue.
   current_time = get_current_time()
-  venues = Venue.query.group_by(Venue.city, Venue.state, 
-          Venue.id, Venue.name).all()
-  parts = []
-  data = []
+  rows = sharding.map_shards(venue_rows, current_time)
+  areas = {}
 
-  for v in venues:
-    upcoming_show = v.shows.filter(current_time < Show.start_time)
-    if v.name not in parts:
-      data.append({'city': v.city, 'state':v.state, 
-        'venues':[{'id':v.id, 'name': v.name, 
-        'num_upcoming_shows': len(upcoming_show.all())}]})
-    else:
-      parts.append(v.name)
+  for id, name, city, state, num_upcoming_shows in sorted(rows):
+    areas.setdefault((city, state), []).append({'id': id, 'name': name,
+      'num_upcoming_shows': num_upcoming_shows or 0})
 
-  return render_template('pages/venues.html', areas=data);
+  data = [{'city': city, 'state': state, 'venues': venues}
+          for (city, state), venues in areas.items()]
+
+  return render_template('pages/venues.html', areas=data)
 
 @app.route('/venues/search', methods=['POST'])
+@limiter.limit('search')
 def search_venues():
   # DONE: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for Hop should return "The Musical Hop".
   # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
   search = request.form['search_term']
-  venues = Venue.query.order_by(Venue.id).filter(Venue.name.ilike('%'+search+'%')).all()
-  count = len(venues)
   current_time = get_current_time()
-  response = {"count" : count, 'data':[]}
-  for venue in venues:
-    upcoming_show = venue.shows.filter(Show.start_time > current_time)
+  venues = sorted(sharding.map_shards(venue_rows, current_time, search))
+  response = {"count" : len(venues), 'data':[]}
+  for id, name, city, state, num_upcoming_shows in venues:
     response["data"].append({
-            "id": venue.id,
-            "name": venue.name,
-            "num_upcoming_shows" : upcoming_show
+            "id": id,
+            "name": name,
+            "num_upcoming_shows" : num_upcoming_shows or 0
         })
 
   return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/venues/<int:venue_id>')
+@conditional(venue_validators)
 def show_venue(venue_id):
   # shows the venue page with the given venue_id
   # DONE: replace with real venue data from the venues table, using venue_id
@@ -113,7 +272,8 @@ def show_venue(venue_id):
   venue = Venue.query.filter(Venue.id == venue_id).first()
   upcoming_shows = venue.shows.filter(Show.start_time > current_time).all()
   # upcoming_shows = venue.shows.filter(Show.start_time > current_time).all()
-  past_shows = venue.shows.filter(Show.start_time < current_time).all()
+  past_shows = get_past_shows(venue, current_time)
+  similar_venues, suggested_artists = recommender.for_venue(venue_id)
 
   past_shows_list = [{
     'artist_id': show.artist.id,
@@ -146,7 +306,9 @@ def show_venue(venue_id):
     "upcoming_shows": upcoming_shows_list,
      "past_shows": past_shows_list,
     "past_shows_count": len(past_shows),
-    "upcoming_shows_count": len(upcoming_shows)
+    "upcoming_shows_count": len(upcoming_shows),
+    "similar_venues": named(Venue, similar_venues),
+    "suggested_artists": named(Artist, suggested_artists)
   }
 
   return render_template('pages/show_venue.html', venue=data)
@@ -160,6 +322,7 @@ def create_venue_form():
   return render_template('forms/new_venue.html', form=form)
 
 @app.route('/venues/create', methods=['POST'])
+@limiter.limit('write')
 def create_venue_submission():
   # DONE: insert form data as a new Venue record in the db, instead
   # TODO: modify data to be the data object returned from db insertion
@@ -217,6 +380,7 @@ def delete_venue(venue_id):
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@conditional(artists_validators)
 def artists():
   # DONE: replace with real data returned from querying the database
   artists = Artist.query.all()
@@ -226,27 +390,33 @@ def artists():
   return render_template('pages/artists.html', artists=data)
 
 @app.route('/artists/search', methods=['POST'])
+@limiter.limit('search')
 def search_artists():
   # DONE: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
   # search for "band" should return "The Wild Sax Band".
 
   search = request.form['search_term']
-  artists = Artist.query.order_by(Artist.id).filter(Artist.name.ilike('%'+search+'%')).all()
-  count = len(artists)
+  artists = sorted(sharding.map_shards(artist_rows, search))
   current_time = get_current_time()
-  response = {"count" : count, 'data':[]}
-  for artist in artists:
-    upcoming_shows = artist.shows.filter(Show.start_time > current_time).all()
+  upcoming = {}
+  if artists:
+    artist_ids = [id for id, name in artists]
+    for artist_id, count in sharding.map_shards(
+        artist_upcoming_counts, artist_ids, current_time):
+      upcoming[artist_id] = upcoming.get(artist_id, 0) + count
+  response = {"count" : len(artists), 'data':[]}
+  for id, name in artists:
     response["data"].append({
-            "id": artist.id,
-            "name": artist.name,
-            "num_upcoming_shows" : len(upcoming_shows)
+            "id": id,
+            "name": name,
+            "num_upcoming_shows" : upcoming.get(id, 0)
         })
   
   return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/artists/<int:artist_id>')
+@conditional(artist_validators)
 def show_artist(artist_id):
   # shows the artist page with the given artist_id
   # TODO: replace with real artist data from the artist table, using artist_id
@@ -255,7 +425,8 @@ def show_artist(artist_id):
   artist = Artist.query.filter(Artist.id == artist_id).first()
   upcoming_shows = artist.shows.filter(Show.start_time > current_time).all()
 
-  past_shows = artist.shows.filter(Show.start_time < current_time).all()
+  past_shows = get_past_shows(artist, current_time)
+  similar_artists, suggested_venues = recommender.for_artist(artist_id)
 
   past_shows_list = [{
     'venue_id': show.venue.id,
@@ -288,6 +459,8 @@ def show_artist(artist_id):
     "upcoming_shows": upcoming_shows_list,
     "past_shows_count": len(past_shows),
     "upcoming_shows_count": len(upcoming_shows),
+    "similar_artists": named(Artist, similar_artists),
+    "suggested_venues": named(Venue, suggested_venues),
   }
 
 
@@ -296,110 +469,206 @@ def show_artist(artist_id):
 
 #  Update
 #  ----------------------------------------------------------------
+
+# Edits only write the columns whose submitted value differs from the stored
+# one and skip the write altogether when nothing changed. The edit forms
+# carry the version they were loaded at; a save against a newer version, or
+# one that loses the race for the row (version_id_col), gets a 409 with the
+# form showing the current values.
+
+ARTIST_FIELDS = ('name', 'city', 'state', 'phone', 'genres', 'facebook_link',
+  'image_link', 'website', 'seeking_venue', 'seeking_description')
+VENUE_FIELDS = ('name', 'city', 'state', 'address', 'phone', 'genres', 'facebook_link',
+  'image_link', 'website', 'seeking_talent', 'seeking_description')
+FLAGS = ('seeking_venue', 'seeking_talent')
+
+def form_data(entity, fields):
+  # stored values as the edit form names them
+  data = dict((field, getattr(entity, field)) for field in fields)
+  data['genres'] = [genre for genre in (entity.genres or '').split(',') if genre]
+  data['website_link'] = data.pop('website')
+  return data
+
+def submitted_values(fields):
+  # column values from the edit form; fields missing from the request are
+  # left alone, except unticked checkboxes, which browsers do not send
+  values = {}
+  for field in fields:
+    name = 'website_link' if field == 'website' else field
+    if field in FLAGS:
+      values[field] = bool(request.form.get(field))
+    elif field == 'genres':
+      values[field] = ','.join(request.form.getlist('genres'))
+    elif name in request.form:
+      values[field] = request.form.get(name)
+  return values
+
+def changed_fields(entity, values):
+  # an empty input does not overwrite an empty (NULL) column
+  changes = {}
+  for key, value in values.items():
+    stored = getattr(entity, key)
+    if stored != value and not (stored is None and not value):
+      changes[key] = value
+  return changes
+
+def is_stale(entity):
+  version = request.form.get('version', type=int)
+  return version is not None and version != entity.version
+
+def edit_artist_page(artist, status=200):
+  form = ArtistForm(formdata=None, data=form_data(artist, ARTIST_FIELDS))
+  data = dict(form_data(artist, ARTIST_FIELDS), id=artist.id, version=artist.version)
+  return render_template('forms/edit_artist.html', form=form, artist=data), status
+
+def edit_venue_page(venue, status=200):
+  form = VenueForm(formdata=None, data=form_data(venue, VENUE_FIELDS))
+  data = dict(form_data(venue, VENUE_FIELDS), id=venue.id, version=venue.version)
+  return render_template('forms/edit_venue.html', form=form, venue=data), status
+
+def conflict(model, entity_id, label):
+  # someone saved in between; show what is stored now
+  db.session.rollback()
+  entity = model.query.filter(model.id == entity_id).first_or_404()
+  flash(label + ' ' + entity.name + ' was changed by someone else in the meantime. '
+    'These are the current values, please make your changes again.')
+  page = edit_artist_page if model is Artist else edit_venue_page
+  return page(entity, 409)
+
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
-  form = ArtistForm()
-
-  get_artist = Artist.query.filter(Artist.id == artist_id).one_or_none()
-
-  if get_artist:
-    artist={
-      "id": get_artist.id,
-      "name": get_artist.name,
-      "genres": get_artist.genres.split(','),
-      "city": get_artist.city,
-      "state": get_artist.state,
-      "phone": get_artist.phone,
-      "website": get_artist.website,
-      "facebook_link": get_artist.facebook_link,
-      "seeking_venue": get_artist.seeking_venue,
-      "seeking_description": get_artist.seeking_description,
-      "image_link": get_artist.image_link
-    }
-  else:
-    artist = {}
   # DONE: populate form with fields from artist with ID <artist_id>
-  return render_template('forms/edit_artist.html', form=form, artist=artist)
+  artist = Artist.query.filter(Artist.id == artist_id).first_or_404()
+  return edit_artist_page(artist)
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
+@limiter.limit('write')
 def edit_artist_submission(artist_id):
   # DONE: take values from the form submitted, and update existing
   # artist record with ID <artist_id> using the new attributes
-
-  body = request.form.to_dict()
-
-  artist = Artist.query.filter(Artist.id == artist_id).one_or_none()
+  artist = Artist.query.filter(Artist.id == artist_id).first_or_404()
+  if is_stale(artist):
+    return conflict(Artist, artist_id, 'Artist')
+  changes = changed_fields(artist, submitted_values(ARTIST_FIELDS))
+  if not changes:
+    flash('Artist ' + artist.name + ' was not changed.')
+    return redirect(url_for('show_artist', artist_id=artist_id))
   try:
-
-    if artist:
-      artist.name = body.get('name')
-      artist.genres = ','.join(body.get('genres'))
-      artist.city = body.get('city')
-      artist.state = body.get('state')
-      artist.phone = body.get('phone')
-      artist.website = body.get('website')
-      artist.facebook_link = body.get('facebook_link')
-      artist.seeking_venue = body.get('seeking_venue')
-      artist.seeking_description = body.get('seeking_description')
-      get_artist.image_link = body.get('image_link')
-
+    for key, value in changes.items():
+      setattr(artist, key, value)
     db.session.commit()
     flash('Artist ' + artist.name + ' was successfully updated!')
+  except StaleDataError:
+    return conflict(Artist, artist_id, 'Artist')
   except:
     db.session.rollback()
-    flash('')
+    flash('An error occurred. Artist could not be updated.')
 
   return redirect(url_for('show_artist', artist_id=artist_id))
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
-  form = VenueForm()
-
-  get_venue = Venue.query.filter(Venue.id == venue_id).one_or_none()
-
-  venue={
-    "id": get_venue.id,
-    "name": get_venue.name,
-    "genres": get_venue.genres.split(','),
-    "address": get_venue.address,
-    "city": get_venue.city,
-    "state": get_venue.state,
-    "phone": get_venue.phone,
-    "website": get_venue.website,
-    "facebook_link": get_venue.facebook_link,
-    "seeking_talent": get_venue.seeking_talent,
-    "seeking_description": get_venue.seeking_description,
-    "image_link": get_venue.image_link
-  }
   # DONE: populate form with values from venue with ID <venue_id>
-  return render_template('forms/edit_venue.html', form=form, venue=venue)
+  venue = Venue.query.filter(Venue.id == venue_id).first_or_404()
+  return edit_venue_page(venue)
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
+@limiter.limit('write')
 def edit_venue_submission(venue_id):
   # DONE: take values from the form submitted, and update existing
   # venue record with ID <venue_id> using the new attributes
-  venue = Venue.query.filter(Venue.id == venue_id).one_or_none()
+  venue = Venue.query.filter(Venue.id == venue_id).first_or_404()
+  if is_stale(venue):
+    return conflict(Venue, venue_id, 'Venue')
+  changes = changed_fields(venue, submitted_values(VENUE_FIELDS))
+  if not changes:
+    flash('Venue ' + venue.name + ' was not changed.')
+    return redirect(url_for('show_venue', venue_id=venue_id))
   try:
-    if venue:
-      venue.name= body.get('name'),
-      venue.city= body['city'],
-      venue.state = body.get('state'),
-      venue.address = body.get('address'),
-      venue.phone = body.get('phone'),
-      venue.image_link = body.get('image_link'),
-      venue.facebook_link = body.get('facebook_link'),
-      venue.genres = ",".join(request.form.getlist('genres')), # DONE: Getting all genres
-      venue.website = body.get('website'),
-      venue.seeking_talent = bool(body.get('seeking_talent')),
-      venue.seeking_description = body.get('seeking_description')
-
-      db.session.commit()
-      flash('Venue ' + venue.name + ' was successfully listed!')
+    for key, value in changes.items():
+      setattr(venue, key, value)
+    db.session.commit()
+    flash('Venue ' + venue.name + ' was successfully updated!')
+  except StaleDataError:
+    return conflict(Venue, venue_id, 'Venue')
   except:
     db.session.rollback()
-    flash('An error occurred. Venue ' + venue.name + ' could not be updated.')
+    flash('An error occurred. Venue could not be updated.')
   return redirect(url_for('show_venue', venue_id=venue_id))
 
+#  Matches
+#  ----------------------------------------------------------------
+
+def match_list(model, ranked):
+  entities = dict((e['id'], e) for e in named(model, [id for id, score, reasons in ranked]))
+  return [dict(entities[id], score=round(score, 2), reasons=reasons)
+          for id, score, reasons in ranked if id in entities]
+
+@app.route('/matches/artists/<int:artist_id>')
+def artist_matches(artist_id):
+  # seeking venues ranked for an artist
+  artist = Artist.query.filter(Artist.id == artist_id).first_or_404()
+  data = {
+    "kind": "artist",
+    "id": artist.id,
+    "name": artist.name,
+    "matches": match_list(Venue, matcher.venues_for_artist(artist)),
+    "match_kind": "venue"
+  }
+  return render_template('pages/matches.html', entity=data)
+
+@app.route('/matches/venues/<int:venue_id>')
+def venue_matches(venue_id):
+  # seeking artists ranked for a venue
+  venue = Venue.query.filter(Venue.id == venue_id).first_or_404()
+  data = {
+    "kind": "venue",
+    "id": venue.id,
+    "name": venue.name,
+    "matches": match_list(Artist, matcher.artists_for_venue(venue)),
+    "match_kind": "artist"
+  }
+  return render_template('pages/matches.html', entity=data)
+
+#  Analytics
+#  ----------------------------------------------------------------
+
+def analytics_data(args):
+  # shows per genre and month and the busiest venues over the last
+  # `months` months (and everything booked after), from the rollup tables
+  months = min(max(args.get('months', 12, type=int), 1), 120)
+  since = rollups.months_ago(months - 1)
+  city = args.get('city') or None
+  state = args.get('state') or None
+  counts = rollups.genre_months(db.session, since, city, state)
+  columns = sorted(set(month for by_month in counts.values() for month in by_month))
+  genres = []
+  for genre, by_month in counts.items():
+    genres.append({
+      "genre": genre,
+      "total": sum(by_month.values()),
+      "by_month": [by_month.get(month, 0) for month in columns]
+    })
+  genres.sort(key=lambda row: (-row['total'], row['genre']))
+  busiest = rollups.busiest_venues(db.session, since, city, state)
+  venues = dict((venue['id'], venue) for venue in named(Venue, [id for id, shows in busiest]))
+  return {
+    "since": since.isoformat(),
+    "city": city,
+    "state": state,
+    "months": [month.strftime('%Y-%m') for month in columns],
+    "genres": genres,
+    "busiest_venues": [dict(venues[id], shows=shows) for id, shows in busiest if id in venues]
+  }
+
+@app.route('/analytics')
+def analytics():
+  return render_template('pages/analytics.html', analytics=analytics_data(request.args))
+
+@app.route('/analytics.json')
+def analytics_json():
+  return Response(json.dumps(analytics_data(request.args)), mimetype='application/json')
+
 #  Create Artist
 #  ----------------------------------------------------------------
 
@@ -409,6 +678,7 @@ def create_artist_form():
   return render_template('forms/new_artist.html', form=form)
 
 @app.route('/artists/create', methods=['POST'])
+@limiter.limit('write')
 def create_artist_submission():
   # called upon submitting the new artist listing form
   # DONE: insert form data as a new Venue record in the db, instead
@@ -448,7 +718,11 @@ def create_artist_submission():
 #  Shows
 #  ----------------------------------------------------------------
 
+def json_response(data, status=200):
+  return Response(json.dumps(data), status=status, mimetype='application/json')
+
 @app.route('/shows')
+@conditional(shows_validators)
 def shows():
   # displays list of shows at /shows
   # DONE: replace with real venues data.
@@ -462,7 +736,8 @@ def shows():
       'artist_id': show.artist_id,
       'artist_name': show.artist.name,
       'artist_image_link': show.artist.image_link,
-      'start_time': str(show.start_time)
+      'start_time': str(show.start_time),
+      'series_id': show.series_id
       })
   # data=[{
   #   "venue_id": 1,
@@ -509,17 +784,22 @@ def create_shows():
   return render_template('forms/new_show.html', form=form)
 
 @app.route('/shows/create', methods=['POST'])
+@limiter.limit('write')
 def create_show_submission():
   # called to create new shows in the db, upon submitting new show listing form
   # DONE: insert form data as a new Show record in the db, instead
 
   body = request.form.to_dict()
+  # unknown artists and venues are caught here instead of at commit
+  rows, results = bookings.validate_shows(db.session, [body])
+  if not rows:
+    flash(('Series' if body.get('repeat') else 'Show') + ' could not be listed: ' +
+          results[0]['error'] + '.')
+    return render_template('pages/home.html')
+  if body.get('repeat'):
+    return create_series_submission(body)
   try:
-    show = Show(
-      venue_id=body.get('venue_id'),
-      artist_id=body.get('artist_id'),
-      start_time=body.get('start_time')
-      )
+    show = Show(**rows[0])
     db.session.add(show)
     db.session.commit()
     # on successful db insert, flash success
@@ -534,6 +814,126 @@ def create_show_submission():
     db.session.close()
   return render_template('pages/home.html')
 
+@app.route('/shows/batch', methods=['POST'])
+@limiter.limit('write')
+def create_shows_batch():
+  # JSON list of {"artist_id", "venue_id", "start_time"}, or {"shows": [...]};
+  # the valid shows are inserted together, the rest reported by index
+  items = request.get_json(silent=True)
+  if isinstance(items, dict):
+    items = items.get('shows')
+  if not isinstance(items, list):
+    return json_response({'error': 'Expected a JSON list of shows.'}, 400)
+  if len(items) > app.config['SHOW_BATCH_MAX']:
+    return json_response({'error': 'At most %d shows per batch.' % app.config['SHOW_BATCH_MAX']}, 413)
+  try:
+    results = bookings.create_shows(db.session, items)
+    db.session.commit()
+  except:
+    db.session.rollback()
+    return json_response({'error': 'An error occurred. No show was listed.'}, 500)
+  finally:
+    db.session.close()
+  created = len([result for result in results if result['ok']])
+  return json_response({'created': created, 'failed': len(results) - created, 'results': results})
+
+#  Show Series
+#  ----------------------------------------------------------------
+
+def series_from_form(series, body):
+  # recurrence fields of the show form; raises ValueError on bad input
+  series.start_time = dateutil.parser.parse(body.get('start_time') or '')
+  series.frequency = body.get('repeat')
+  series.interval = int(body.get('interval') or 1)
+  if not 1 <= series.interval <= 12:
+    raise ValueError('Repeat every 1 to 12 weeks or months.')
+  series.until = dateutil.parser.parse(body['until']).date() if body.get('until') else None
+  series.count = int(body['count']) if body.get('count') else None
+  series.exceptions = ','.join(sorted(
+    day.isoformat() for day in bookings.parse_exceptions(body.get('exceptions'))))
+
+def create_series_submission(body):
+  # the whole series is expanded and inserted in one transaction; the
+  # artist and venue were checked by create_show_submission
+  try:
+    series = ShowSeries(venue_id=int(body.get('venue_id')), artist_id=int(body.get('artist_id')))
+    series_from_form(series, body)
+    created = bookings.create_series(db.session, series)
+    db.session.commit()
+    flash('Series of %d shows was successfully listed!' % created)
+  except (TypeError, ValueError) as error:
+    db.session.rollback()
+    flash('Series could not be listed: ' + str(error))
+  except:
+    db.session.rollback()
+    flash("An error occurred. Series could not be listed.")
+  finally:
+    db.session.close()
+  return render_template('pages/home.html')
+
+@app.route('/series/<int:series_id>')
+def show_series(series_id):
+  series = ShowSeries.query.filter(ShowSeries.id == series_id).first_or_404()
+  current_time = datetime.now()
+  form = ShowForm(data={
+    "start_time": series.start_time,
+    "repeat": series.frequency,
+    "interval": series.interval,
+    "until": series.until,
+    "count": series.count,
+    "exceptions": series.exceptions
+  })
+  # at most SHOW_SERIES_MAX_SHOWS rows
+  start_times = [start_time for start_time, in series.shows.with_entities(
+    Show.start_time).order_by(Show.start_time)]
+  upcoming_shows = [str(start_time) for start_time in start_times if start_time > current_time]
+  data = {
+    "id": series.id,
+    "venue_id": series.venue_id,
+    "venue_name": series.venue.name,
+    "artist_id": series.artist_id,
+    "artist_name": series.artist.name,
+    "cancelled": series.cancelled_at is not None,
+    "upcoming_shows": upcoming_shows,
+    "past_shows_count": len(start_times) - len(upcoming_shows)
+  }
+  return render_template('forms/edit_series.html', form=form, series=data)
+
+@app.route('/series/<int:series_id>/edit', methods=['POST'])
+@limiter.limit('write')
+def edit_series_submission(series_id):
+  # replaces every upcoming show of the series at once
+  series = ShowSeries.query.filter(ShowSeries.id == series_id).first_or_404()
+  try:
+    series_from_form(series, request.form.to_dict())
+    upcoming = bookings.reschedule_series(db.session, series, datetime.now())
+    db.session.commit()
+    flash('Series was successfully updated, %d upcoming shows.' % upcoming)
+  except ValueError as error:
+    db.session.rollback()
+    flash('Series could not be updated: ' + str(error))
+  except:
+    db.session.rollback()
+    flash('An error occurred. Series could not be updated.')
+  finally:
+    db.session.close()
+  return redirect(url_for('show_series', series_id=series_id))
+
+@app.route('/series/<int:series_id>/cancel', methods=['POST'])
+@limiter.limit('write')
+def cancel_series(series_id):
+  series = ShowSeries.query.filter(ShowSeries.id == series_id).first_or_404()
+  try:
+    removed = bookings.cancel_series(db.session, series, datetime.now())
+    db.session.commit()
+    flash('Series was cancelled, %d upcoming shows removed.' % removed)
+  except:
+    db.session.rollback()
+    flash('An error occurred. Series could not be cancelled.')
+  finally:
+    db.session.close()
+  return redirect(url_for('show_series', series_id=series_id))
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -553,6 +953,9 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
+if app.config.get('TEMPLATE_WARMUP'):
+  warm_templates()
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import select, text
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from models import db, Show, ShowArchive
+
+# "Show" is range-partitioned by start_time on Postgres: one partition for
+# everything before the current month, one per month from there on and a
+# default partition for anything further out. Queries for upcoming shows
+# (start_time > now) are pruned down to the monthly partitions and the
+# default one, whatever the size of the history.
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return 'Show_y%04dm%02d' % (month.year, month.month)
+
+
+def is_partitioned(conn):
+    return conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE relname = 'Show'"
+    )).scalar() == 'p'
+
+
+def partition_table(conn):
+    """Rebuild "Show" as a partitioned table, copying the existing rows.
+
+    The foreign keys and indexes are recreated from the `Show` model. Raises
+    ValueError when a show has no start_time, which no partition can hold.
+    """
+    undated = conn.execute(text(
+        'SELECT count(*) FROM "Show" WHERE start_time IS NULL')).scalar()
+    if undated:
+        raise ValueError('%d shows have no start_time; set or delete them first.' % undated)
+    first_month = month_start(datetime.now())
+    conn.execute(text('ALTER TABLE "Show" RENAME TO "Show_unpartitioned"'))
+    conn.execute(text('ALTER SEQUENCE "Show_id_seq" OWNED BY NONE'))
+    conn.execute(text(
+        'CREATE TABLE "Show" (LIKE "Show_unpartitioned" INCLUDING DEFAULTS) '
+        'PARTITION BY RANGE (start_time)'))
+    conn.execute(text(
+        'CREATE TABLE "Show_history" PARTITION OF "Show" '
+        'FOR VALUES FROM (MINVALUE) TO (:first_month)'
+    ).bindparams(first_month=first_month))
+    conn.execute(text('CREATE TABLE "Show_default" PARTITION OF "Show" DEFAULT'))
+    conn.execute(text('INSERT INTO "Show" SELECT * FROM "Show_unpartitioned"'))
+    # its constraint and index names are taken until it is gone
+    conn.execute(text('DROP TABLE "Show_unpartitioned"'))
+    conn.execute(text('ALTER SEQUENCE "Show_id_seq" OWNED BY "Show".id'))
+    # the partition key has to be part of the primary key
+    conn.execute(text('ALTER TABLE "Show" ADD PRIMARY KEY (id, start_time)'))
+    table = Show.__table__
+    for constraint in sorted(table.foreign_key_constraints, key=lambda c: c.column_keys):
+        conn.execute(AddConstraint(constraint))
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        conn.execute(CreateIndex(index))
+
+
+def add_month_partitions(conn, months_ahead):
+    """Create the monthly partitions from this month to `months_ahead` out.
+
+    Rows that already landed in the default partition for one of those
+    months are moved into the new partition before it is attached.
+    """
+    existing = set(conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'Show'"
+    )).scalars())
+    created = []
+    month = month_start(datetime.now())
+    for _ in range(months_ahead + 1):
+        name = partition_name(month)
+        if name not in existing:
+            bounds = {'lo': month, 'hi': next_month(month)}
+            conn.execute(text(
+                'CREATE TABLE "%s" (LIKE "Show" INCLUDING DEFAULTS)' % name))
+            conn.execute(text(
+                'WITH moved AS (DELETE FROM "Show_default" '
+                'WHERE start_time >= :lo AND start_time < :hi RETURNING *) '
+                'INSERT INTO "%s" SELECT * FROM moved' % name
+            ).bindparams(**bounds))
+            conn.execute(text(
+                'ALTER TABLE "Show" ATTACH PARTITION "%s" '
+                'FOR VALUES FROM (:lo) TO (:hi)' % name
+            ).bindparams(**bounds))
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+def drop_empty_partitions(conn, before):
+    """Drop monthly partitions that end before `before` and hold no rows."""
+    dropped = []
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'Show' AND c.relname LIKE 'Show\\_y%' ORDER BY 1"
+    )).scalars().all()
+    for name in names:
+        month = datetime(int(name[6:10]), int(name[11:13]), 1)
+        if next_month(month) > before:
+            continue
+        if conn.execute(text('SELECT 1 FROM "%s" LIMIT 1' % name)).first():
+            continue
+        conn.execute(text('ALTER TABLE "Show" DETACH PARTITION "%s"' % name))
+        conn.execute(text('DROP TABLE "%s"' % name))
+        dropped.append(name)
+    return dropped
+
+
+def archive_past_shows(before):
+    """Move every show that started before `before` into "ShowArchive".
+
+    Runs as a single INSERT ... SELECT and DELETE in one transaction and
+    returns the number of shows moved.
+    """
+    shows = Show.__table__
+    columns = [shows.c.id, shows.c.venue_id, shows.c.artist_id, shows.c.start_time]
+    conn = db.session.connection()
+    conn.execute(ShowArchive.__table__.insert().from_select(
+        [c.name for c in columns],
+        select(*columns).where(shows.c.start_time < before)))
+    moved = conn.execute(shows.delete().where(shows.c.start_time < before)).rowcount
+    if conn.dialect.name == 'postgresql' and is_partitioned(conn):
+        drop_empty_partitions(conn, before)
+    db.session.commit()
+    return moved
+
+
+def init_app(app):
+    @app.cli.command('partition-shows')
+    @click.option('--months-ahead', default=None, type=int,
+                  help='Monthly partitions to keep ahead of today.')
+    def partition_shows_command(months_ahead):
+        """Partition "Show" by start_time and roll the monthly partitions forward."""
+        conn = db.session.connection()
+        if conn.dialect.name != 'postgresql':
+            raise click.ClickException('Partitioning needs a PostgreSQL database.')
+        if months_ahead is None:
+            months_ahead = app.config['SHOW_PARTITION_MONTHS_AHEAD']
+        if not is_partitioned(conn):
+            try:
+                partition_table(conn)
+            except ValueError as error:
+                raise click.ClickException(str(error))
+            click.echo('Partitioned "Show" by start_time.')
+        for name in add_month_partitions(conn, months_ahead):
+            click.echo('Created partition %s.' % name)
+        db.session.commit()
+
+    @app.cli.command('archive-shows')
+    @click.option('--days', default=None, type=int,
+                  help='Archive shows that started more than this many days ago.')
+    def archive_shows_command(days):
+        """Move old past shows into the archive table."""
+        if days is None:
+            days = app.config['SHOW_ARCHIVE_AFTER_DAYS']
+        moved = archive_past_shows(datetime.now() - timedelta(days=days))
+        click.echo('Archived %d shows.' % moved)
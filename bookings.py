@@ -0,0 +1,246 @@
+import csv
+import json
+from datetime import datetime, time
+
+import click
+import dateutil.parser
+from dateutil.rrule import rrule, WEEKLY, MONTHLY
+from flask import current_app
+from sqlalchemy import and_, literal, select, union_all
+
+import changelog
+import rollups
+import sharding
+from models import db, Venue, Artist, Show
+from recommend import recommender
+
+# Creating and removing shows in bulk.
+#
+# insert_shows() writes any number of shows with one multi-row INSERT per
+# shard and tells the rollups, the recommender and the change log about
+# them, as the session hooks would for shows added one by one. A show series is a recurrence rule
+# (weekly or monthly, until a date or for a number of shows, minus exception
+# dates) expanded here into its shows; editing or cancelling a series
+# replaces or removes all of its upcoming shows with one statement each.
+#
+# Batches of shows (/shows/batch, `flask create-shows`) are checked item by
+# item, with a single query for all the artists and venues they reference,
+# and the valid ones go in through insert_shows().
+
+FREQUENCIES = {'weekly': WEEKLY, 'monthly': MONTHLY}
+INSERT_CHUNK = 1000
+
+
+def shows_connection(session, venue_id):
+    # the connection holding a venue's shows
+    if sharding.router is None:
+        return session.connection()
+    shard = sharding.router.shard_for_id(venue_id)
+    return session.connection(bind_arguments={'shard_id': shard})
+
+
+def show_change(action, venue_id, artist_id):
+    # bulk statements do not return the ids of the shows they touch
+    return {'kind': 'show', 'action': action, 'entity_id': None,
+            'venue_id': venue_id, 'artist_id': artist_id}
+
+
+def insert_shows(session, rows):
+    """Insert shows given as dicts of `Show` columns; returns how many.
+
+    Runs in the session's transaction, so a rollback undoes them. With
+    sharding the rows are grouped by the shard of their venue and get their
+    ids here.
+    """
+    groups = {}
+    for row in rows:
+        shard = None if sharding.router is None else sharding.router.shard_for_id(row['venue_id'])
+        groups.setdefault(shard, []).append(row)
+    table = Show.__table__
+    for shard, group in groups.items():
+        conn = shows_connection(session, group[0]['venue_id'])
+        if shard is not None:
+            ids = sharding.router.next_ids(conn, table, shard, len(group))
+            group = [dict(row, id=id) for row, id in zip(group, ids)]
+        for start in range(0, len(group), INSERT_CHUNK):
+            conn.execute(table.insert().values(group[start:start + INSERT_CHUNK]))
+    rollups.apply_shows(session, [(row['artist_id'], row['venue_id'], row['start_time'])
+                                  for row in rows])
+    recommender.record(session, [(row['artist_id'], row['venue_id']) for row in rows])
+    changelog.record(session, [show_change('created', row['venue_id'], row['artist_id'])
+                               for row in rows])
+    return len(rows)
+
+
+def parse_show(item):
+    """(row, None) for a valid show item, (None, error) otherwise."""
+    if not isinstance(item, dict):
+        return None, 'not an object'
+    row = {}
+    for key in ('artist_id', 'venue_id'):
+        try:
+            row[key] = int(item.get(key))
+        except (TypeError, ValueError):
+            return None, '%s must be a number' % key
+    start_time = item.get('start_time')
+    if not start_time or not isinstance(start_time, str):
+        return None, 'start_time is missing'
+    try:
+        row['start_time'] = dateutil.parser.parse(start_time)
+    except (ValueError, OverflowError):
+        return None, 'start_time is not a date'
+    return row, None
+
+
+def existing_ids(session, artist_ids, venue_ids):
+    """(artist ids, venue ids) of those that exist, with one query."""
+    query = union_all(
+        select(literal('artist'), Artist.id).where(Artist.id.in_(artist_ids)),
+        select(literal('venue'), Venue.id).where(Venue.id.in_(venue_ids)))
+    found = {'artist': set(), 'venue': set()}
+    for kind, id in session.execute(query):
+        found[kind].add(id)
+    return found['artist'], found['venue']
+
+
+def validate_shows(session, items):
+    """Split show items into insertable rows and one result per item."""
+    parsed = [parse_show(item) for item in items]
+    artists, venues = existing_ids(
+        session, set(row['artist_id'] for row, error in parsed if row),
+        set(row['venue_id'] for row, error in parsed if row))
+    rows, results = [], []
+    for index, (row, error) in enumerate(parsed):
+        if row is not None and row['artist_id'] not in artists:
+            error = 'no artist with id %d' % row['artist_id']
+        elif row is not None and row['venue_id'] not in venues:
+            error = 'no venue with id %d' % row['venue_id']
+        if error:
+            results.append({'index': index, 'ok': False, 'error': error})
+        else:
+            rows.append(row)
+            results.append({'index': index, 'ok': True})
+    return rows, results
+
+
+def create_shows(session, items):
+    """Insert the valid shows of a batch; returns the per-item results."""
+    rows, results = validate_shows(session, items)
+    if rows:
+        insert_shows(session, rows)
+    return results
+
+
+def parse_exceptions(text):
+    """Dates in a comma separated list; raises ValueError on a bad one."""
+    dates = set()
+    for part in (text or '').split(','):
+        if part.strip():
+            dates.add(dateutil.parser.parse(part.strip()).date())
+    return dates
+
+
+def occurrences(start_time, frequency, interval=1, until=None, count=None, exceptions=()):
+    """Start times of a series, exception dates left out.
+
+    `count` counts the exception dates too. Raises ValueError when the rule
+    has no end or yields more than SHOW_SERIES_MAX_SHOWS shows.
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError('Unknown frequency %r.' % frequency)
+    if until is None and not count:
+        raise ValueError('A series needs an end date or a number of shows.')
+    limit = current_app.config.get('SHOW_SERIES_MAX_SHOWS', 260)
+    rule = rrule(FREQUENCIES[frequency], dtstart=start_time, interval=interval or 1,
+                 count=count or None,
+                 until=datetime.combine(until, time.max) if until else None)
+    times = []
+    for value in rule:
+        if value.date() in exceptions:
+            continue
+        if len(times) == limit:
+            raise ValueError('A series can have at most %d shows.' % limit)
+        times.append(value)
+    if not times:
+        raise ValueError('This series has no shows.')
+    return times
+
+
+def series_times(series):
+    return occurrences(series.start_time, series.frequency, series.interval,
+                       series.until, series.count, parse_exceptions(series.exceptions))
+
+
+def series_rows(series, times):
+    return [{'venue_id': series.venue_id, 'artist_id': series.artist_id,
+             'start_time': start_time, 'series_id': series.id} for start_time in times]
+
+
+def create_series(session, series):
+    """Add `series` and all of its shows; returns the number of shows."""
+    times = series_times(series)
+    session.add(series)
+    session.flush()
+    return insert_shows(session, series_rows(series, times))
+
+
+def remove_upcoming(session, series, now):
+    # one DELETE for every show of the series after `now`
+    criteria = and_(Show.series_id == series.id, Show.start_time > now)
+    removed = session.query(Show.artist_id, Show.venue_id, Show.start_time).filter(criteria).all()
+    if removed:
+        shows_connection(session, series.venue_id).execute(
+            Show.__table__.delete().where(criteria))
+        rollups.apply_shows(session, removed, -1)
+        changelog.record(session, [show_change('deleted', venue_id, artist_id)
+                                   for artist_id, venue_id, start_time in removed])
+    return len(removed)
+
+
+def reschedule_series(session, series, now):
+    """Replace the upcoming shows of `series` after its rule changed.
+
+    Shows that already took place stay as they are, a cancelled series is
+    booked again. Returns the number of upcoming shows.
+    """
+    series.cancelled_at = None
+    times = [start_time for start_time in series_times(series) if start_time > now]
+    remove_upcoming(session, series, now)
+    session.flush()
+    return insert_shows(session, series_rows(series, times))
+
+
+def cancel_series(session, series, now):
+    """Remove the upcoming shows of `series`; returns how many."""
+    series.cancelled_at = now
+    removed = remove_upcoming(session, series, now)
+    session.flush()
+    return removed
+
+
+def read_items(f, name):
+    # a JSON list (or {"shows": [...]}) or CSV with a header row
+    if name.endswith('.csv'):
+        return list(csv.DictReader(f))
+    items = json.load(f)
+    return items.get('shows') if isinstance(items, dict) else items
+
+
+def init_app(app):
+
+    @app.cli.command('create-shows')
+    @click.argument('source', type=click.File('r'))
+    def create_shows_command(source):
+        """Create the shows listed in SOURCE (JSON or .csv, - for stdin)."""
+        try:
+            items = read_items(source, source.name)
+        except ValueError as error:
+            raise click.ClickException('Could not read %s: %s' % (source.name, error))
+        if not isinstance(items, list):
+            raise click.ClickException('Expected a list of shows.')
+        results = create_shows(db.session, items)
+        db.session.commit()
+        failed = [result for result in results if not result['ok']]
+        for result in failed:
+            click.echo('#%d: %s' % (result['index'], result['error']), err=True)
+        click.echo('Created %d shows, %d failed.' % (len(results) - len(failed), len(failed)))
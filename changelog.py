@@ -0,0 +1,272 @@
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import click
+from flask import Response, request
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from models import db, Venue, Artist, Show, ChangeLog
+
+# Change log and the /events/shows server-sent events stream.
+#
+# Every flush that creates, changes or deletes a venue, artist or show writes
+# one ChangeLog row per entity in the same transaction, so the log holds
+# exactly the committed changes; bulk statements call record() themselves.
+#
+# Streams do not query the database. One thread per process reads the log
+# every EVENTS_POLL_INTERVAL seconds while anyone is listening and keeps the
+# last EVENTS_BUFFER changes in memory. A stream sends what is newer than the
+# client's Last-Event-ID, after waiting EVENTS_COALESCE_SECONDS for a burst
+# to settle; changes to the same entity in one batch go out as one event, as
+# do the shows of one artist at one venue inserted in bulk. A client too far
+# behind for the buffer gets a "reset" event and should reload.
+#
+# Ids are handed out before commit, so a transaction committing late makes a
+# lower id visible after higher ones. The feed therefore publishes ids in
+# order only: at a missing id it waits, and skips it once it has been missing
+# for CHANGELOG_SETTLE_SECONDS (a rolled back transaction leaves such a gap
+# for good). Changes older than that are taken as final, see settled_id().
+
+KINDS = {Venue: 'venue', Artist: 'artist', Show: 'show'}
+
+
+def entry(obj, action):
+    kind = KINDS[type(obj)]
+    venue_id = obj.id if kind == 'venue' else getattr(obj, 'venue_id', None)
+    artist_id = obj.id if kind == 'artist' else getattr(obj, 'artist_id', None)
+    return {'kind': kind, 'action': action, 'entity_id': obj.id,
+            'venue_id': venue_id, 'artist_id': artist_id}
+
+
+def record(session, entries):
+    """Log changes made with bulk statements, in the session's transaction.
+
+    `entries` are dicts with kind, action, entity_id, venue_id and artist_id.
+    """
+    if entries:
+        now = datetime.utcnow()
+        session.connection().execute(ChangeLog.__table__.insert(),
+                                     [dict(e, changed_at=now) for e in entries])
+
+
+def before_flush(session, flush_context, instances):
+    # deleted rows can still be read before the flush
+    deleted = [entry(obj, 'deleted') for obj in session.deleted if type(obj) in KINDS]
+    if deleted:
+        session.info.setdefault('changelog_deleted', []).extend(deleted)
+
+
+def after_flush(session, flush_context):
+    entries = [entry(obj, 'created') for obj in session.new if type(obj) in KINDS]
+    entries += [entry(obj, 'updated') for obj in session.dirty
+                if type(obj) in KINDS and session.is_modified(obj, include_collections=False)]
+    entries += session.info.pop('changelog_deleted', [])
+    record(session, entries)
+
+
+def settled_id(session, seconds):
+    """Newest change log id that no late commit can still come in below."""
+    before = datetime.utcnow() - timedelta(seconds=seconds)
+    return session.query(func.max(ChangeLog.id)).filter(
+        ChangeLog.changed_at <= before).scalar() or 0
+
+
+def coalesce(events):
+    """One event per entity (or bulk show pair), carrying the latest id."""
+    merged = {}
+    for e in events:
+        if e['entity_id'] is not None:
+            key = (e['kind'], e['entity_id'])
+        else:
+            key = (e['kind'], None, e['venue_id'], e['artist_id'], e['action'])
+        first = merged.get(key)
+        if first is None:
+            merged[key] = dict(e, count=1)
+        else:
+            action = e['action']
+            if first['action'] == 'created' and action == 'updated':
+                action = 'created'
+            merged[key] = dict(e, action=action, count=first['count'] + 1)
+    return sorted(merged.values(), key=lambda e: e['id'])
+
+
+def format_event(e):
+    data = dict((key, value) for key, value in e.items() if key != 'id')
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (e['id'], e['kind'], json.dumps(data))
+
+
+class ChangeFeed(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cond = threading.Condition()
+        self.events = deque()
+        self.last_id = None
+        # (first missing id, when the poller first found it missing)
+        self.gap = None
+        self.dropped_through = 0
+        self.listeners = 0
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.poll_interval = app.config.get('EVENTS_POLL_INTERVAL', 1.0)
+        self.coalesce_seconds = app.config.get('EVENTS_COALESCE_SECONDS', 0.5)
+        self.buffer = app.config.get('EVENTS_BUFFER', 1000)
+        self.stream_seconds = app.config.get('EVENTS_STREAM_SECONDS', 30)
+        self.heartbeat = app.config.get('EVENTS_HEARTBEAT', 15)
+        self.settle_seconds = app.config.get('CHANGELOG_SETTLE_SECONDS', 10)
+        event.listen(Session, 'before_flush', before_flush)
+        event.listen(Session, 'after_flush', after_flush)
+        app.add_url_rule('/events/shows', 'show_events', self.stream_view)
+
+        @app.cli.command('prune-changelog')
+        @click.option('--days', type=int, default=app.config.get('CHANGELOG_KEEP_DAYS', 7),
+                      help='Keep the changes of this many days.')
+        def prune_changelog_command(days):
+            """Delete change log rows older than --days."""
+            before = datetime.utcnow() - timedelta(days=days)
+            deleted = ChangeLog.query.filter(ChangeLog.changed_at < before).delete(
+                synchronize_session=False)
+            db.session.commit()
+            click.echo('Deleted %d changes from before %s.' % (deleted, before.date()))
+
+    # reading the log
+
+    def load(self, after, limit):
+        rows = db.session.query(ChangeLog).filter(ChangeLog.id > after).order_by(
+            ChangeLog.id).limit(limit).all()
+        events = [{'id': row.id, 'kind': row.kind, 'action': row.action,
+                   'entity_id': row.entity_id, 'venue_id': row.venue_id,
+                   'artist_id': row.artist_id} for row in rows]
+        self.add_names(events)
+        return events
+
+    def add_names(self, events):
+        # one query per kind for the whole batch; deleted ones have no name
+        for model, key in ((Venue, 'venue'), (Artist, 'artist')):
+            ids = set(e[key + '_id'] for e in events if e[key + '_id'] is not None)
+            names = dict(db.session.query(model.id, model.name).filter(
+                model.id.in_(ids)).all()) if ids else {}
+            for e in events:
+                e[key + '_name'] = names.get(e[key + '_id'])
+
+    def head(self):
+        if self.last_id is None:
+            with self.cond:
+                if self.last_id is None:
+                    # newer changes are picked up by the poller
+                    self.last_id = settled_id(db.session, self.settle_seconds)
+                    self.dropped_through = self.last_id
+        return self.last_id
+
+    def gap_settled(self, missing):
+        if self.gap is None or self.gap[0] != missing:
+            self.gap = (missing, time.time())
+        return time.time() - self.gap[1] >= self.settle_seconds
+
+    def poll(self):
+        events = []
+        expected = self.last_id + 1
+        for e in self.load(self.last_id, self.buffer):
+            if e['id'] != expected and not self.gap_settled(expected):
+                break
+            events.append(e)
+            expected = e['id'] + 1
+        if not events:
+            return
+        with self.cond:
+            self.events.extend(events)
+            while len(self.events) > self.buffer:
+                self.dropped_through = self.events.popleft()['id']
+            self.last_id = events[-1]['id']
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.listeners:
+                    self.cond.wait()
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception:
+                self.app.logger.exception('Reading the change log failed')
+            time.sleep(self.poll_interval)
+
+    # streaming
+
+    def since(self, last_id):
+        with self.cond:
+            if last_id < self.dropped_through:
+                return None
+            return [e for e in self.events if e['id'] > last_id]
+
+    def wait(self, last_id, timeout):
+        with self.cond:
+            if self.since(last_id) == []:
+                self.cond.wait(timeout)
+        return self.since(last_id)
+
+    def listen(self, change):
+        with self.cond:
+            self.listeners += change
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='changefeed', daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def stream(self, last_id, backlog):
+        self.listen(1)
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.time() + self.stream_seconds
+            pending = backlog
+            while time.time() < deadline:
+                if pending is None:
+                    # too far behind; start over from the newest change
+                    last_id = self.last_id
+                    yield 'id: %d\nevent: reset\ndata: {}\n\n' % last_id
+                elif pending:
+                    for e in coalesce(pending):
+                        yield format_event(e)
+                        last_id = e['id']
+                elif self.wait(last_id, self.heartbeat) == []:
+                    yield ': keepalive\n\n'
+                else:
+                    # a burst started, give it a moment to settle
+                    time.sleep(self.coalesce_seconds)
+                pending = self.since(last_id)
+        finally:
+            self.listen(-1)
+
+    def stream_view(self):
+        head = self.head()
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            last_id = int(last_id) if last_id else head
+        except ValueError:
+            last_id = head
+        last_id = min(last_id, head)
+        backlog = self.since(last_id)
+        if backlog is None:
+            # older than the buffer; read the gap once, or reset the client
+            backlog = self.load(last_id, self.buffer + 1)
+            backlog = [e for e in backlog if e['id'] <= head]
+            if len(backlog) > self.buffer:
+                backlog = None
+            else:
+                backlog += self.since(head) or []
+        response = Response(self.stream(last_id, backlog), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+feed = ChangeFeed()
@@ -0,0 +1,60 @@
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import Response, current_app, make_response, request, session
+
+# Conditional GET for pages built from the database.
+#
+# A view decorated with `conditional(validators)` first calls
+# `validators(**view_args)`, which only runs cheap aggregate queries
+# (max(updated_at), row counts) and returns the list of values the page
+# depends on plus its last modification time. When the client's
+# If-None-Match still matches, the answer is a 304 and neither the page's
+# queries nor its template run.
+#
+# If-Modified-Since alone never gets a 304: deleting a row does not move
+# max(updated_at), only the row counts in the ETag notice it. Last-Modified
+# is still sent, for information.
+
+
+def latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def make_etag(parts):
+    parts = [current_app.config.get('ETAG_VERSION', '')] + list(parts)
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+
+
+def not_modified(etag):
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+
+def conditional(validators):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # pending flash messages are part of the page
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+            found = validators(**kwargs)
+            if found is None:
+                return view(*args, **kwargs)
+            parts, last_modified = found
+            etag = make_etag(parts)
+            if last_modified is not None:
+                last_modified = last_modified.replace(
+                    microsecond=0, tzinfo=timezone.utc)
+            if not_modified(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
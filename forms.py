@@ -1,6 +1,6 @@
 from datetime import datetime
 from flask_wtf import Form
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField, DateField, IntegerField
 from wtforms.validators import DataRequired, AnyOf, URL, Regexp
 
 class ShowForm(Form):
@@ -15,6 +15,29 @@ class ShowForm(Form):
         validators=[DataRequired()],
         default= datetime.today()
     )
+    # recurrence, expanded into one show per date by bookings.py
+    repeat = SelectField(
+        'repeat',
+        choices=[
+            ('', 'Does not repeat'),
+            ('weekly', 'Weekly'),
+            ('monthly', 'Monthly'),
+        ],
+        default=''
+    )
+    interval = IntegerField(
+        'interval', default=1
+    )
+    until = DateField(
+        'until'
+    )
+    count = IntegerField(
+        'count'
+    )
+    exceptions = StringField(
+        # comma separated YYYY-MM-DD dates to skip
+        'exceptions'
+    )
 
 class VenueForm(Form):
     name = StringField(
@@ -0,0 +1,319 @@
+import hashlib
+import http.client
+import ipaddress
+import json
+import os
+import socket
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from functools import partial
+from io import BytesIO
+
+from flask import abort, current_app, redirect, request, send_file, url_for
+from markupsafe import Markup
+
+from models import Venue, Artist
+
+try:
+    from PIL import Image
+    # UnidentifiedImageError is an OSError
+    BAD_IMAGE = (OSError, ValueError, Image.DecompressionBombError)
+except ImportError:  # thumbnails need Pillow; without it the original is served
+    Image = None
+    BAD_IMAGE = (OSError, ValueError)
+
+# Local proxy for the remote `image_link` pictures.
+#
+# /img/<kind>/<id>?w=<width> fetches the entity's image once, keeps it on
+# disk and serves it scaled down to the nearest standard width. Every cached
+# image has three kinds of files under IMAGE_CACHE_DIR, all named after the
+# hash of the source url:
+#
+#   <key>.json       source url, its ETag/Last-Modified and fetch time
+#   <key>.src        the original bytes
+#   <key>.<w>.jpg    one per width served so far
+#
+# After IMAGE_REVALIDATE_AFTER seconds the source is revalidated with a
+# conditional request. File mtimes double as LRU timestamps: they are bumped
+# on every hit and the least recently used files go once the directory grows
+# past IMAGE_CACHE_MAX_BYTES.
+#
+# image_link is user input, so the proxy only talks to public addresses:
+# every connection, redirects included, resolves the host itself and refuses
+# loopback, private, link-local, multicast and reserved addresses, and
+# IMAGE_ALLOWED_HOSTS can narrow it down to known image hosts.
+# IMAGE_ALLOW_PRIVATE_HOSTS lets loopback and private addresses through, for
+# a local image server in development and tests. Environment
+# proxies are not used, they would hide the real destination.
+
+MODELS = {'venue': Venue, 'artist': Artist}
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+
+def checked_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
+                       allow_private=False):
+    """socket.create_connection() refusing non-public hosts; raises ValueError.
+
+    The checked address is the one connected to, so the host cannot resolve
+    to something else in between. `allow_private` lets loopback and private
+    addresses through, for local image servers.
+    """
+    host, port = address
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as error:
+        raise ValueError('cannot resolve image host %s: %s' % (host, error))
+    for family, socktype, proto, canonname, sockaddr in infos:
+        ip = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if ip.is_global and not (ip.is_multicast or ip.is_reserved):
+            continue
+        if allow_private and (ip.is_private or ip.is_loopback) and not ip.is_unspecified:
+            continue
+        raise ValueError('image host %s resolves to %s, which is not public' % (host, ip))
+    return socket.create_connection((infos[0][4][0], port), timeout, source_address)
+
+
+class CheckedHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = partial(checked_connection, allow_private=allow_private)
+
+
+class CheckedHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = partial(checked_connection, allow_private=allow_private)
+
+
+class CheckedHTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, allow_private=False):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        return self.do_open(CheckedHTTPConnection, req, allow_private=self.allow_private)
+
+
+class CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, allow_private=False):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        return self.do_open(CheckedHTTPSConnection, req, context=self._context,
+                            allow_private=self.allow_private)
+
+
+class CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+
+    def __init__(self, allowed):
+        self.allowed = allowed
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.allowed(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class ImageCache(object):
+
+    def __init__(self, directory, max_bytes, revalidate_after, timeout, allowed_hosts=None,
+                 allow_private=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.timeout = timeout
+        self.allowed_hosts = allowed_hosts
+        self.opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}), CheckedHTTPHandler(allow_private),
+            CheckedHTTPSHandler(allow_private),
+            CheckedRedirectHandler(self.allowed))
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def write(self, path, data):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def load_meta(self, key):
+        try:
+            with open(self.path(key, '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_meta(self, key, meta):
+        self.write(self.path(key, '.json'), json.dumps(meta).encode('utf-8'))
+
+    def allowed(self, url):
+        """Raise ValueError unless `url` may be fetched."""
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.hostname or '').lower()
+        if parts.scheme not in ('http', 'https') or not host:
+            raise ValueError('not an http(s) image url: %s' % url)
+        if self.allowed_hosts is not None and not any(
+                host == allowed or host.endswith('.' + allowed) for allowed in self.allowed_hosts):
+            raise ValueError('image host %s is not allowed' % host)
+
+    def fetch(self, url, meta):
+        """Fetch `url`, revalidating against `meta`; returns (meta, body).
+
+        body is None when the cached copy is still current.
+        """
+        self.allowed(url)
+        headers = {'User-Agent': 'fyyur-image-proxy'}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            with self.opener.open(urllib.request.Request(url, headers=headers),
+                                  timeout=self.timeout) as response:
+                body = response.read(MAX_SOURCE_BYTES + 1)
+                if len(body) > MAX_SOURCE_BYTES:
+                    raise ValueError('image too large: %s' % url)
+                return {'url': url, 'fetched_at': time.time(),
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}, body
+        except urllib.error.HTTPError as error:
+            if error.code == 304 and meta:
+                return dict(meta, fetched_at=time.time()), None
+            raise
+
+    def source(self, url):
+        """Return the cache key for `url`, fetching or revalidating as needed."""
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        meta = self.load_meta(key)
+        have_source = meta is not None and os.path.exists(self.path(key, '.src'))
+        if have_source and time.time() - meta['fetched_at'] < self.revalidate_after:
+            return key
+        try:
+            meta, body = self.fetch(url, meta if have_source else None)
+        except (OSError, ValueError) as error:
+            if have_source:  # serve the stale copy rather than nothing
+                current_app.logger.warning('Image revalidation failed: %s', error)
+                return key
+            raise
+        if body is not None:
+            self.write(self.path(key, '.src'), body)
+            for name in os.listdir(self.directory):
+                if name.startswith(key + '.') and name.endswith('.jpg'):
+                    os.remove(os.path.join(self.directory, name))
+        self.save_meta(key, meta)
+        self.evict()
+        return key
+
+    def discard(self, key):
+        # forget a source that turned out to be unusable
+        for suffix in ('.json', '.src'):
+            try:
+                os.remove(self.path(key, suffix))
+            except OSError:
+                pass
+
+    def variant(self, key, width):
+        """Path of the image scaled to `width`, creating it if needed."""
+        source = self.path(key, '.src')
+        if Image is None:
+            os.utime(source)
+            return source
+        path = self.path(key, '.%d.jpg' % width)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        image = Image.open(source)
+        image.thumbnail((width, width * 4))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = BytesIO()
+        image.save(out, 'JPEG', quality=80, optimize=True, progressive=True)
+        self.write(path, out.getvalue())
+        self.evict()
+        return path
+
+    def evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        # drop least recently used files until 10% below the limit
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def nearest_width(widths, requested):
+    for width in widths:
+        if width >= requested:
+            return width
+    return widths[-1]
+
+
+def image_view(kind, entity_id):
+    model = MODELS.get(kind)
+    if model is None:
+        abort(404)
+    rows = model.query.with_entities(model.image_link).filter(
+        model.id == entity_id).all()
+    url = rows[0][0] if rows else None
+    if not url or not url.startswith(('http://', 'https://')):
+        abort(404)
+    widths = current_app.config['IMAGE_WIDTHS']
+    width = nearest_width(widths, request.args.get('w', widths[-1], type=int))
+    cache = current_app.extensions['image_cache']
+    try:
+        key = cache.source(url)
+    except (OSError, ValueError) as error:
+        current_app.logger.warning('Image fetch failed: %s', error)
+        return redirect(url)
+    try:
+        path = cache.variant(key, width)
+    except BAD_IMAGE as error:
+        # not an image (an error page, say); fetch it again next time
+        current_app.logger.warning('Image %s unreadable: %s', url, error)
+        cache.discard(key)
+        return redirect(url)
+    return send_file(path, mimetype='image/jpeg' if Image else None,
+                     max_age=cache.revalidate_after, conditional=True)
+
+
+def responsive_img(kind, entity_id, link, alt, sizes='100vw'):
+    """<img> tag pointing at the proxy, with a srcset of the standard widths."""
+    if not link or not current_app.config.get('IMAGE_PROXY'):
+        return Markup('<img src="{}" alt="{}" />').format(link or '', alt)
+    widths = current_app.config['IMAGE_WIDTHS']
+    urls = [url_for('image', kind=kind, entity_id=entity_id, w=width)
+            for width in widths]
+    srcset = ', '.join('%s %dw' % (url, width) for url, width in zip(urls, widths))
+    return Markup('<img src="{}" srcset="{}" sizes="{}" alt="{}" />').format(
+        urls[len(urls) // 2], srcset, sizes, alt)
+
+
+def init_app(app):
+    app.jinja_env.globals['responsive_img'] = responsive_img
+    if not app.config.get('IMAGE_PROXY'):
+        return
+    app.extensions['image_cache'] = ImageCache(
+        app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'],
+        app.config['IMAGE_REVALIDATE_AFTER'], app.config['IMAGE_FETCH_TIMEOUT'],
+        app.config.get('IMAGE_ALLOWED_HOSTS'), app.config.get('IMAGE_ALLOW_PRIVATE_HOSTS', False))
+    app.add_url_rule('/img/<kind>/<int:entity_id>', 'image', image_view)
@@ -0,0 +1,260 @@
+import heapq
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Venue, Artist, Show, ShowArchive
+
+# Talent matching between seeking venues and seeking artists.
+#
+# For each side the index keeps the seeking entities with their genres as a
+# bitmask, grouped by state and by genre mask. Only entities that share the
+# state, a genre or a past booking with the one asked about can score above
+# zero, and those outside the state that were never booked score the same
+# as everyone else with their genre mask, so a query costs the size of one
+# state plus the number of distinct genre combinations:
+#
+#   3 x genre overlap (Jaccard) + 1 same state + 1 same city
+#   + 2 booked together before
+#
+# Venues and artists committed in this process update the index right away;
+# a full rebuild every MATCHES_REBUILD_AFTER seconds picks up the rest. It
+# loads into a new index and swaps it in, queries are not held up meanwhile.
+
+GENRE_WEIGHT = 3.0
+STATE_WEIGHT = 1.0
+CITY_WEIGHT = 1.0
+BOOKED_WEIGHT = 2.0
+
+
+def split_genres(genres):
+    return [genre for genre in (genres or '').split(',') if genre]
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+class Side(object):
+    """Seeking venues or seeking artists."""
+
+    def __init__(self):
+        self.entries = {}
+        self.by_mask = {}
+        self.by_state = {}
+
+    def remove(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is None:
+            return
+        mask, city, state = entry
+        self.by_mask[mask].discard(id)
+        if not self.by_mask[mask]:
+            del self.by_mask[mask]
+        self.by_state[state].discard(id)
+
+    def add(self, id, mask, city, state):
+        self.remove(id)
+        self.entries[id] = (mask, city, state)
+        self.by_mask.setdefault(mask, set()).add(id)
+        self.by_state.setdefault(state, set()).add(id)
+
+
+class Matcher(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.rebuilding = False
+        # changes committed while a build loads, applied to it once swapped in
+        self.missed = None
+        self.genre_bits = {}
+        self.venues = Side()
+        self.artists = Side()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.k = app.config.get('MATCHES_K', 20)
+        self.rebuild_after = app.config.get('MATCHES_REBUILD_AFTER', 600)
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_rollback', self.after_rollback)
+
+    def mask(self, genres, bits=None):
+        # new genres get the next free bit in `bits`, self.genre_bits by default
+        bits = self.genre_bits if bits is None else bits
+        mask = 0
+        for genre in split_genres(genres):
+            if genre not in bits:
+                bits[genre] = len(bits)
+            mask |= 1 << bits[genre]
+        return mask
+
+    def entry(self, genres, city, state, bits=None):
+        return self.mask(genres, bits), (city or '').strip().lower(), state
+
+    # building
+
+    def build(self):
+        """Load both sides into a new index and swap it in.
+
+        Queries keep using the current index meanwhile; venues and artists
+        committed during the load are applied to the new one as well.
+        """
+        with self.lock:
+            self.missed = []
+        try:
+            venue_rows = db.session.query(
+                Venue.id, Venue.genres, Venue.city, Venue.state).filter(
+                Venue.seeking_talent.is_(True)).all()
+            artist_rows = db.session.query(
+                Artist.id, Artist.genres, Artist.city, Artist.state).filter(
+                Artist.seeking_venue.is_(True)).all()
+            with self.lock:
+                bits = dict(self.genre_bits)
+            venues, artists = Side(), Side()
+            for id, genres, city, state in venue_rows:
+                venues.add(id, *self.entry(genres, city, state, bits))
+            for id, genres, city, state in artist_rows:
+                artists.add(id, *self.entry(genres, city, state, bits))
+            with self.lock:
+                self.genre_bits, self.venues, self.artists = bits, venues, artists
+                self.built_at = time.time()
+                self._apply(self.missed)
+        finally:
+            with self.lock:
+                self.missed = None
+
+    def ensure_built(self):
+        # the first build runs in the request, later ones in the background
+        if self.built_at is None:
+            self.build()
+        elif time.time() - self.built_at > self.rebuild_after:
+            with self.lock:
+                if self.rebuilding:
+                    return
+                self.rebuilding = True
+            threading.Thread(target=self.rebuild_in_background, daemon=True).start()
+
+    def rebuild_in_background(self):
+        try:
+            with self.app.app_context():
+                self.build()
+        finally:
+            self.rebuilding = False
+
+    def apply(self, changes):
+        with self.lock:
+            if self.missed is not None:
+                self.missed.extend(changes)
+            self._apply(changes)
+
+    def _apply(self, changes):
+        # with the lock held
+        for kind, id, seeking, genres, city, state in changes:
+            side = self.venues if kind == 'venue' else self.artists
+            if seeking:
+                side.add(id, *self.entry(genres, city, state))
+            else:
+                side.remove(id)
+
+    # session hooks
+
+    def after_flush(self, session, flush_context):
+        changes = []
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Venue):
+                changes.append(('venue', obj.id, obj.seeking_talent, obj.genres, obj.city, obj.state))
+            elif isinstance(obj, Artist):
+                changes.append(('artist', obj.id, obj.seeking_venue, obj.genres, obj.city, obj.state))
+        for obj in session.deleted:
+            if isinstance(obj, (Venue, Artist)):
+                changes.append((obj.__tablename__.lower(), obj.id, False, None, None, None))
+        if changes:
+            session.info.setdefault('match_changes', []).extend(changes)
+
+    def after_commit(self, session):
+        changes = session.info.pop('match_changes', None)
+        if changes and (self.built_at is not None or self.missed is not None):
+            self.apply(changes)
+
+    def after_rollback(self, session):
+        session.info.pop('match_changes', None)
+
+    # queries
+
+    def score(self, target, entry, booked, id):
+        mask, city, state = target
+        other_mask, other_city, other_state = entry
+        shared = popcount(mask & other_mask)
+        score = 0.0
+        reasons = []
+        if shared:
+            score += GENRE_WEIGHT * shared / popcount(mask | other_mask)
+            reasons.append('%d shared %s' % (shared, 'genre' if shared == 1 else 'genres'))
+        if state and state == other_state:
+            score += STATE_WEIGHT
+            if city and city == other_city:
+                score += CITY_WEIGHT
+                reasons.append('same city')
+            else:
+                reasons.append('same state')
+        if id in booked:
+            score += BOOKED_WEIGHT
+            reasons.append('booked together before')
+        return score, reasons
+
+    def rank(self, side, target, booked):
+        # entities in the same state or booked before are scored one by one;
+        # everyone else can only score on genres, which depends on the genre
+        # mask alone, so those are scored once per distinct mask
+        mask = target[0]
+        special = side.by_state.get(target[2], set()) | (booked & side.entries.keys())
+        scored = []
+        for id in special:
+            score, reasons = self.score(target, side.entries[id], booked, id)
+            scored.append((score, -id, reasons))
+        groups = []
+        for other_mask, ids in side.by_mask.items():
+            if mask & other_mask:
+                score, reasons = self.score(target, (other_mask, None, None), (), None)
+                groups.append((score, ids, reasons))
+        taken = 0
+        for score, ids, reasons in sorted(groups, key=lambda group: -group[0]):
+            if taken >= self.k:
+                break
+            for id in heapq.nsmallest(self.k, ids - special):
+                scored.append((score, -id, reasons))
+                taken += 1
+        return [(-negative_id, score, reasons) for score, negative_id, reasons
+                in heapq.nlargest(self.k, scored)]
+
+    def venues_for_artist(self, artist):
+        """[(venue id, score, reasons)] of seeking venues for `artist`."""
+        self.ensure_built()
+        booked = set(id for id, in db.session.query(Show.venue_id).filter(
+            Show.artist_id == artist.id).distinct())
+        booked |= set(id for id, in db.session.query(ShowArchive.venue_id).filter(
+            ShowArchive.artist_id == artist.id).distinct())
+        with self.lock:
+            target = self.entry(artist.genres, artist.city, artist.state)
+            return self.rank(self.venues, target, booked)
+
+    def artists_for_venue(self, venue):
+        """[(artist id, score, reasons)] of seeking artists for `venue`."""
+        self.ensure_built()
+        booked = set(id for id, in db.session.query(Show.artist_id).filter(
+            Show.venue_id == venue.id).distinct())
+        booked |= set(id for id, in db.session.query(ShowArchive.artist_id).filter(
+            ShowArchive.venue_id == venue.id).distinct())
+        with self.lock:
+            target = self.entry(venue.genres, venue.city, venue.state)
+            return self.rank(self.artists, target, booked)
+
+
+matcher = Matcher()
@@ -0,0 +1,300 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, message_flashed, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import sharding
+from models import db
+from ratelimit import limiter
+
+# Prometheus metrics at /metrics.
+#
+# Recording only touches in-process dicts under a lock. Every process dumps
+# its numbers to METRICS_DIR/metrics-<pid>.json at most once every
+# METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of all
+# workers, so any prefork worker can answer the scrape. Counters and
+# histograms of workers that have exited are kept: a scrape folds their files
+# into metrics-exited.json, so recycled workers do not pile up files. Gauges
+# (the connection pool) are only reported for live processes.
+
+EXITED = 'metrics-exited.json'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'fyyur_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'fyyur_requests_total': ('counter', 'Requests by endpoint and status code.'),
+    'fyyur_exceptions_total': ('counter', 'Requests that raised an exception.'),
+    'fyyur_sql_duration_seconds': ('histogram', 'SQL statement duration by statement type.'),
+    'fyyur_template_render_seconds': ('histogram', 'Template render time.'),
+    'fyyur_flashes_total': ('counter', 'Flashed messages by category.'),
+    'fyyur_ratelimit_total': ('counter', 'Rate limiter decisions by scope and outcome.'),
+    'fyyur_db_pool_checked_out': ('gauge', 'Connections checked out of the pool.'),
+    'fyyur_db_pool_overflow': ('gauge', 'Connections open beyond the pool size.'),
+}
+
+
+class Metrics(object):
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.app = None
+        self.directory = None
+        self.flushed = 0
+        if app is not None:
+            self.init_app(app)
+
+    # recording
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect_left(BUCKETS, value)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                # one slot per bucket, +Inf, then the sum
+                counts = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    # hooks
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def after_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'none'
+            self.observe('fyyur_request_duration_seconds',
+                         (('endpoint', endpoint), ('method', request.method)),
+                         time.perf_counter() - started)
+            self.inc('fyyur_requests_total',
+                     (('endpoint', endpoint), ('status', str(response.status_code))))
+        if self.directory and time.time() - self.flushed > self.flush_interval:
+            self.flush()
+        return response
+
+    def teardown_request(self, exc=None):
+        if exc is not None:
+            self.inc('fyyur_exceptions_total', (('endpoint', request.endpoint or 'none'),))
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['metrics_started'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('metrics_started', None)
+        if started is not None:
+            self.observe_statement(statement, started)
+
+    def handle_error(self, context):
+        # a failed statement never reaches after_cursor_execute
+        conn = context.connection
+        started = conn.info.pop('metrics_started', None) if conn is not None else None
+        if started is not None:
+            self.observe_statement(context.statement or '', started)
+
+    def observe_statement(self, statement, started):
+        operation = statement.lstrip()[:6].upper()
+        self.observe('fyyur_sql_duration_seconds', (('operation', operation),),
+                     time.perf_counter() - started)
+
+    def before_render_template(self, app, template, context, **extra):
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+    def template_rendered(self, app, template, context, **extra):
+        started = g.metrics_templates.pop()
+        self.observe('fyyur_template_render_seconds',
+                     (('template', template.name or 'string'),),
+                     time.perf_counter() - started)
+
+    def message_flashed(self, app, message, category, **extra):
+        self.inc('fyyur_flashes_total', (('category', category),))
+
+    # collection
+
+    def gauges(self):
+        if sharding.router is not None:
+            engines = sharding.router.engines.items()
+        else:
+            engines = [('default', db.get_engine(self.app))]
+        values = {}
+        for shard, engine in engines:
+            pool = engine.pool
+            if hasattr(pool, 'checkedout'):
+                values['fyyur_db_pool_checked_out', (('shard', shard),)] = pool.checkedout()
+            if hasattr(pool, 'overflow'):
+                values['fyyur_db_pool_overflow', (('shard', shard),)] = pool.overflow()
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key, list(counts)) for key, counts in self.histograms.items())
+        # the rate limiter keeps its own counters
+        for (scope, outcome), value in list(limiter.counters.items()):
+            counters['fyyur_ratelimit_total', (('scope', scope), ('outcome', outcome))] = value
+        return counters, histograms
+
+    def flush(self):
+        counters, histograms = self.snapshot()
+        write_file(os.path.join(self.directory, 'metrics-%d.json' % os.getpid()),
+                   os.getpid(), counters, histograms, self.gauges())
+        self.flushed = time.time()
+
+    def collect(self):
+        """Counters, histograms and gauges added up over all processes."""
+        counters, histograms = self.snapshot()
+        gauges = dict(((name, labels + (('pid', str(os.getpid())),)), value)
+                      for (name, labels), value in self.gauges().items())
+        if self.directory:
+            self.merge_exited()
+        for _, data in self.other_processes():
+            add_counts(counters, histograms, data)
+            if data['pid'] is not None and pid_alive(data['pid']):
+                for name, labels, value in data['gauges']:
+                    labels = tuple(map(tuple, labels)) + (('pid', str(data['pid'])),)
+                    gauges[name, labels] = value
+        return counters, histograms, gauges
+
+    def merge_exited(self):
+        """Fold the files of exited workers into EXITED and remove them."""
+        with open(os.path.join(self.directory, '.merge.lock'), 'w') as lock:
+            # one scrape at a time, or two could both count the same file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = [(name, data) for name, data in self.other_processes()
+                      if name != EXITED and not pid_alive(data['pid'])]
+            if not exited:
+                return
+            counters, histograms = {}, {}
+            for name, data in self.other_processes():
+                if name == EXITED:
+                    add_counts(counters, histograms, data)
+            for name, data in exited:
+                add_counts(counters, histograms, data)
+            write_file(os.path.join(self.directory, EXITED), None, counters, histograms, {})
+            for name, data in exited:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def other_processes(self):
+        """(file name, data) of the files of other processes and EXITED."""
+        if not self.directory:
+            return
+        own = 'metrics-%d.json' % os.getpid()
+        for name in os.listdir(self.directory):
+            if name.startswith('metrics-') and name.endswith('.json') and name != own:
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        yield name, json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+    def render(self):
+        counters, histograms, gauges = self.collect()
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), counts in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels), counts[-1]))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+        for (name, labels), value in gauges.items():
+            series.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        out = []
+        for name in sorted(series):
+            kind, text = HELP.get(name, ('untyped', name))
+            out.append('# HELP %s %s' % (name, text))
+            out.append('# TYPE %s %s' % (name, kind))
+            out.extend(sorted(series[name]))
+        return '\n'.join(out) + '\n'
+
+    def metrics_view(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def init_app(self, app):
+        if not app.config.get('METRICS_ENABLED'):
+            return
+        self.app = app
+        self.directory = app.config.get('METRICS_DIR')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            atexit.register(self.flush)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+        message_flashed.connect(self.message_flashed, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+
+def add_counts(counters, histograms, data):
+    # add the counters and histograms of a metrics file to the given dicts
+    for name, labels, value in data['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, counts in data['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        if key in histograms:
+            histograms[key] = [a + b for a, b in zip(histograms[key], counts)]
+        else:
+            histograms[key] = counts
+
+
+def write_file(path, pid, counters, histograms, gauges):
+    data = {
+        'pid': pid,
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, counts] for (name, labels), counts in histograms.items()],
+        'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+    }
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for key, value in labels)
+
+
+metrics = Metrics()
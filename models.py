@@ -1,4 +1,6 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 
 db = SQLAlchemy()
 
@@ -19,6 +21,11 @@ class Venue(db.Model):
     seeking_talent = db.Column(db.Boolean)
     seeking_description = db.Column(db.String)
     shows = db.relationship('Show', backref='venue', lazy='dynamic')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # optimistic locking: every UPDATE checks and bumps it
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 
@@ -39,6 +46,11 @@ class Artist(db.Model):
     seeking_venue = db.Column(db.Boolean)
     seeking_description = db.Column(db.String)
     shows = db.relationship('Show', backref='artist', lazy='dynamic')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # optimistic locking: every UPDATE checks and bumps it
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     # def __init__(self, name, city,state, phone, genres, image_link, facebook_link, seeking_venue,seeking_description):
     #     self.name = name
@@ -61,7 +73,86 @@ class Artist(db.Model):
 class Show(db.Model):
   __tablename__ = "Show"
 
+  id = db.Column(db.Integer, primary_key=True)
+  venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False, index=True)
+  artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False, index=True)
+  # the partition key on Postgres (archive.py), so never NULL there
+  start_time = db.Column(db.DateTime)
+  updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+  series_id = db.Column(db.Integer, db.ForeignKey('ShowSeries.id'), index=True)
+
+class ShowSeries(db.Model):
+  # a recurring booking, expanded into one Show per date by bookings.py
+  __tablename__ = "ShowSeries"
+
   id = db.Column(db.Integer, primary_key=True)
   venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
   artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)
+  start_time = db.Column(db.DateTime, nullable=False)
+  frequency = db.Column(db.String(10), nullable=False)
+  interval = db.Column(db.Integer, nullable=False, default=1)
+  until = db.Column(db.Date)
+  count = db.Column(db.Integer)
+  # comma separated YYYY-MM-DD dates without a show
+  exceptions = db.Column(db.String, default='')
+  cancelled_at = db.Column(db.DateTime)
+  updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+  venue = db.relationship('Venue')
+  artist = db.relationship('Artist')
+  shows = db.relationship('Show', backref='series', lazy='dynamic')
+
+class ShowArchive(db.Model):
+  # past shows moved out of "Show" by `flask archive-shows`; keeps the
+  # original show id
+  __tablename__ = "ShowArchive"
+
+  id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+  venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False, index=True)
+  artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False, index=True)
   start_time = db.Column(db.DateTime)
+  venue = db.relationship('Venue', backref=db.backref('archived_shows', lazy='dynamic'))
+  artist = db.relationship('Artist', backref=db.backref('archived_shows', lazy='dynamic'))
+
+class GenreMonthRollup(db.Model):
+  # shows per artist genre, venue city and month, kept up to date by rollups.py
+  __tablename__ = "GenreMonthRollup"
+
+  genre = db.Column(db.String(120), primary_key=True)
+  city = db.Column(db.String(120), primary_key=True)
+  state = db.Column(db.String(120), primary_key=True)
+  month = db.Column(db.Date, primary_key=True)
+  show_count = db.Column(db.Integer, nullable=False, default=0)
+
+class VenueMonthRollup(db.Model):
+  # shows per venue and month, kept up to date by rollups.py
+  __tablename__ = "VenueMonthRollup"
+
+  venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), primary_key=True)
+  month = db.Column(db.Date, primary_key=True)
+  show_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ShardIdCounter(db.Model):
+  # last id handed out per table on one shard, see sharding.py
+  __tablename__ = "ShardIdCounter"
+
+  table_name = db.Column(db.String(64), primary_key=True)
+  last_id = db.Column(db.Integer, nullable=False)
+
+class ChangeLog(db.Model):
+  # one row per venue, artist or show written, read by /events/shows;
+  # entity_id is empty for shows inserted in bulk
+  __tablename__ = "ChangeLog"
+
+  id = db.Column(db.Integer, primary_key=True)
+  kind = db.Column(db.String(10), nullable=False)
+  action = db.Column(db.String(10), nullable=False)
+  entity_id = db.Column(db.Integer)
+  venue_id = db.Column(db.Integer)
+  artist_id = db.Column(db.Integer)
+  changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+def upsert(connection, table):
+  # INSERT supporting .on_conflict_do_update() / .on_conflict_do_nothing(),
+  # for the two databases the app runs on
+  dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+  return dialect.insert(table)
@@ -0,0 +1,134 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, request
+
+from admin import admin_required, is_admin
+
+# Sampling profiler for selected requests.
+#
+# While a profiled request runs, a background thread looks at that request's
+# stack every PROFILE_INTERVAL seconds and counts it in collapsed-stack
+# format ("frame;frame;frame count"), the input of flamegraph.pl and
+# speedscope. The first two frames of every stack are the endpoint and
+# where the time went: "sql" when the database driver is on the stack,
+# "template" when a Jinja template is, "python" otherwise.
+#
+# A request is profiled when its endpoint is in PROFILE_ENDPOINTS, when it is
+# picked at random with probability PROFILE_SAMPLE_RATE, or when an admin
+# sends "X-Profile: 1". With PROFILER_ENABLED off no hooks are installed.
+
+SQL_MODULES = (os.sep + 'sqlalchemy' + os.sep + 'engine' + os.sep,
+               os.sep + 'sqlite3' + os.sep, os.sep + 'psycopg')
+TEMPLATE_MODULES = (os.sep + 'jinja2' + os.sep, '.html')
+MAX_DEPTH = 96
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame):
+    names = []
+    category = 'python'
+    while frame is not None and len(names) < MAX_DEPTH:
+        filename = frame.f_code.co_filename
+        if category != 'sql':
+            if any(m in filename for m in SQL_MODULES):
+                category = 'sql'
+            elif any(m in filename for m in TEMPLATE_MODULES):
+                category = 'template'
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return category, ';'.join(names)
+
+
+class Profiler(object):
+
+    def __init__(self, app=None):
+        self.samples = Counter()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get('PROFILE_INTERVAL', 0.005)
+        self.endpoints = set(app.config.get('PROFILE_ENDPOINTS', ()))
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        app.add_url_rule('/admin/profile', 'profile', admin_required(self.report_view))
+        app.add_url_rule('/admin/profile', 'profile_reset',
+                         admin_required(self.reset_view), methods=['DELETE'])
+        if app.config.get('PROFILER_ENABLED'):
+            app.before_request(self.before_request)
+            app.teardown_request(self.teardown_request)
+
+    def wanted(self):
+        if request.endpoint in self.endpoints:
+            return True
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        return request.headers.get('X-Profile') == '1' and is_admin()
+
+    def before_request(self):
+        if request.endpoint and self.wanted():
+            with self.lock:
+                self.active[threading.get_ident()] = request.endpoint
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='profiler', daemon=True)
+                    self.thread.start()
+            self.wake.set()
+
+    def teardown_request(self, exc=None):
+        if self.active:
+            with self.lock:
+                self.active.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            if not self.active:
+                self.wake.clear()
+                if not self.active:
+                    self.wake.wait()
+            frames = sys._current_frames()
+            with self.lock:
+                active = list(self.active.items())
+            stacks = []
+            for ident, endpoint in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks.append('%s;%s;%s' % ((endpoint,) + collapse(frame)))
+            del frames
+            with self.lock:
+                self.samples.update(stacks)
+            time.sleep(self.interval)
+
+    def report(self, endpoint=None):
+        with self.lock:
+            samples = sorted(self.samples.items())
+        lines = []
+        for stack, count in samples:
+            if endpoint is None or stack.startswith(endpoint + ';'):
+                lines.append('%s %d' % (stack, count))
+        return '\n'.join(lines) + '\n'
+
+    def report_view(self):
+        return Response(self.report(request.args.get('endpoint')),
+                        mimetype='text/plain')
+
+    def reset_view(self):
+        with self.lock:
+            self.samples.clear()
+        return Response(status=204)
+
+
+profiler = Profiler()
@@ -0,0 +1,191 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import Response, jsonify, request
+
+from admin import admin_required
+
+# Admission control for the endpoints that do unbounded database work.
+#
+# Every client gets a token bucket per scope ("search", "write"); a request
+# without a token left is answered with 429. On top of that each scope has a
+# cap on requests in flight, so a burst is shed with 503 right away instead
+# of piling up waiting for a database connection. Both answers carry a
+# Retry-After header.
+#
+# A bucket that has refilled to capacity is the same as no bucket, so each
+# one records when that happens (full_at) and the stores drop such buckets
+# every SWEEP_INTERVAL seconds; clients seen once do not stay around.
+
+SWEEP_INTERVAL = 60
+
+
+def refill(bucket, capacity, rate, now):
+    """(allowed, tokens left, time the bucket is full again) after one take."""
+    tokens, updated = bucket or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    return allowed, tokens, now + (capacity - tokens) / rate
+
+
+class MemoryStore(object):
+    """Token buckets kept in this process."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept = time.time()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            allowed, tokens, full_at = refill(bucket and bucket[:2], capacity, rate, now)
+            self.buckets[key] = (tokens, now, full_at)
+            if now - self.swept > SWEEP_INTERVAL:
+                self.sweep(now)
+        return allowed, tokens
+
+    def sweep(self, now):
+        # with the lock held
+        self.buckets = dict((key, bucket) for key, bucket in self.buckets.items()
+                            if bucket[2] > now)
+        self.swept = now
+
+
+class SQLiteStore(object):
+    """Token buckets in a local SQLite file shared by all workers on a host."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.swept = time.time()
+        conn = self.connection()
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(buckets)')]
+        if columns and 'full_at' not in columns:
+            # a file from before full_at; buckets are cheap to lose
+            conn.execute('DROP TABLE buckets')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS buckets '
+            '(key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)')
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+        return self.local.connection
+
+    def take(self, key, capacity, rate, now):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            allowed, tokens, full_at = refill(row, capacity, rate, now)
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) '
+                         'VALUES (?, ?, ?, ?)', (key, tokens, now, full_at))
+            if now - self.swept > SWEEP_INTERVAL:
+                # every worker sweeps now and then, which is cheap with the index
+                conn.execute('DELETE FROM buckets WHERE full_at <= ?', (now,))
+                self.swept = now
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+
+class Limiter(object):
+
+    def __init__(self, app=None):
+        self.counters = Counter()
+        self.in_flight = Counter()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        self.limits = app.config.get('RATELIMITS', {})
+        self.concurrency = app.config.get('CONCURRENCY_LIMITS', {})
+        self.trust_proxy = app.config.get('RATELIMIT_TRUST_PROXY', False)
+        path = app.config.get('RATELIMIT_STORAGE')
+        self.store = SQLiteStore(path) if path else MemoryStore()
+        self.semaphores = dict((scope, threading.BoundedSemaphore(size))
+                               for scope, size in self.concurrency.items())
+        app.add_url_rule('/admin/limits', 'limits', admin_required(self.stats_view))
+
+    def client(self):
+        if self.trust_proxy and request.access_route:
+            return request.access_route[0]
+        return request.remote_addr or 'unknown'
+
+    def count(self, scope, outcome):
+        with self.lock:
+            self.counters[scope, outcome] += 1
+
+    def admit(self, scope):
+        """Return (allowed, seconds until the client gets a token back)."""
+        if scope not in self.limits:
+            return True, 0
+        requests, seconds = self.limits[scope]
+        rate = float(requests) / seconds
+        allowed, tokens = self.store.take(
+            '%s:%s' % (scope, self.client()), requests, rate, time.time())
+        return allowed, math.ceil((1 - tokens) / rate)
+
+    def limit(self, scope):
+        """Decorate a view with the rate and concurrency limits of `scope`."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                allowed, retry_after = self.admit(scope)
+                if not allowed:
+                    self.count(scope, 'limited')
+                    return Response('Too many requests, slow down.', 429,
+                                    {'Retry-After': str(retry_after)})
+                semaphore = self.semaphores.get(scope)
+                if semaphore is not None and not semaphore.acquire(blocking=False):
+                    self.count(scope, 'shed')
+                    return Response('Server busy, try again shortly.', 503,
+                                    {'Retry-After': '1'})
+                self.count(scope, 'admitted')
+                with self.lock:
+                    self.in_flight[scope] += 1
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    with self.lock:
+                        self.in_flight[scope] -= 1
+                    if semaphore is not None:
+                        semaphore.release()
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for (scope, outcome), value in self.counters.items():
+                stats.setdefault(scope, {})[outcome] = value
+            for scope, value in self.in_flight.items():
+                stats.setdefault(scope, {})['in_flight'] = value
+        for scope, size in self.concurrency.items():
+            stats.setdefault(scope, {})['max_in_flight'] = size
+        for scope, (requests, seconds) in self.limits.items():
+            stats.setdefault(scope, {})['rate'] = '%d/%ds' % (requests, seconds)
+        return stats
+
+    def stats_view(self):
+        return jsonify(self.stats())
+
+
+limiter = Limiter()
@@ -0,0 +1,244 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Show, ShowArchive
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # recommendations need numpy and scipy
+    np = sparse = None
+
+# Co-booking recommendations.
+#
+# All shows, live and archived, are counted into a sparse artist x venue
+# matrix M. Two artists are similar when they played the same venues (cosine
+# of their rows of M), two venues when the same artists played them (cosine
+# of their columns). For every artist the engine keeps its top-k similar
+# artists and the top-k venues its similar artists played that it has not;
+# for every venue its top-k similar venues and the artists that played those
+# but not this one. Lookups are a dict access returning at most k ids.
+#
+# The first lookup starts a build in a background thread. Shows committed in
+# this process are then applied right away, recomputing only the rows they
+# affect; a full rebuild every RECOMMENDATIONS_REBUILD_AFTER seconds picks up
+# what other workers added. Rebuilds fill new lists and swap them in when
+# done, lookups meanwhile get the old ones.
+
+CHUNK = 1024
+
+
+def top_k(row, k, exclude=()):
+    """Column indices of the k largest entries of a sparse row, best first."""
+    indices, values = row.indices, row.data
+    if len(exclude):
+        keep = ~np.isin(indices, exclude)
+        indices, values = indices[keep], values[keep]
+    keep = values > 0
+    indices, values = indices[keep], values[keep]
+    if len(values) > k:
+        best = np.argpartition(-values, k)[:k]
+        indices, values = indices[best], values[best]
+    return indices[np.argsort(-values, kind='stable')]
+
+
+def normalize_rows(matrix):
+    norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A.ravel()
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+class Recommender(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.rebuilding = False
+        # shows committed during a build, applied once it is swapped in
+        self.missed = None
+        self.similar_artists = {}
+        self.suggested_venues = {}
+        self.similar_venues = {}
+        self.suggested_artists = {}
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def init_app(self, app):
+        self.app = None
+        if np is None or not app.config.get('RECOMMENDATIONS_ENABLED'):
+            return
+        self.app = app
+        self.k = app.config.get('RECOMMENDATIONS_K', 6)
+        self.rebuild_after = app.config.get('RECOMMENDATIONS_REBUILD_AFTER', 600)
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_rollback', self.after_rollback)
+
+    # building
+
+    def load_pairs(self):
+        pairs = db.session.query(Show.artist_id, Show.venue_id).all()
+        pairs += db.session.query(ShowArchive.artist_id, ShowArchive.venue_id).all()
+        return pairs
+
+    def build(self, pairs):
+        """Build the matrix and every recommendation list from (artist, venue) pairs.
+
+        Lookups keep using the previous lists until the new ones are complete.
+        """
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        artist_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+        venue_ids, cols = np.unique(pairs[:, 1], return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(pairs)), (rows, cols)),
+            shape=(len(artist_ids), len(venue_ids)))
+        matrix.sum_duplicates()
+        lists = ({}, {}, {}, {})
+        self.compute(matrix, artist_ids, venue_ids, np.arange(len(artist_ids)),
+                     np.arange(len(venue_ids)), *lists)
+        artist_index = dict((id, i) for i, id in enumerate(artist_ids.tolist()))
+        venue_index = dict((id, i) for i, id in enumerate(venue_ids.tolist()))
+        with self.lock:
+            self.artist_ids, self.venue_ids = artist_ids, venue_ids
+            self.artist_index, self.venue_index = artist_index, venue_index
+            self.matrix = matrix
+            (self.similar_artists, self.suggested_venues,
+             self.similar_venues, self.suggested_artists) = lists
+            self.built_at = time.time()
+            # shows committed here while the build ran
+            missed, self.missed = self.missed, None
+            if missed:
+                self._add_shows(missed)
+
+    def refresh(self, artists, venues):
+        """Recompute the lists of the given artist and venue indices."""
+        self.compute(self.matrix, self.artist_ids, self.venue_ids, artists, venues,
+                     self.similar_artists, self.suggested_venues,
+                     self.similar_venues, self.suggested_artists)
+
+    def compute(self, m, artist_ids, venue_ids, artists, venues,
+                similar_artists, suggested_venues, similar_venues, suggested_artists):
+        mt = m.T.tocsr()
+        self._refresh_side(artists, normalize_rows(m), m, artist_ids,
+                           venue_ids, similar_artists, suggested_venues)
+        self._refresh_side(venues, normalize_rows(mt), mt, venue_ids,
+                           artist_ids, similar_venues, suggested_artists)
+
+    def _refresh_side(self, indices, unit, counts, ids, other_ids, similar, suggested):
+        for start in range(0, len(indices), CHUNK):
+            chunk = indices[start:start + CHUNK]
+            scores = (unit[chunk] @ unit.T).tocsr()
+            reach = (scores @ counts).tocsr()
+            for n, i in enumerate(chunk):
+                similar[ids[i]] = ids[top_k(scores[n], self.k, exclude=[i])]
+                suggested[ids[i]] = other_ids[
+                    top_k(reach[n], self.k, exclude=counts[i].indices)]
+
+    def add_shows(self, pairs):
+        """Count new (artist_id, venue_id) shows in and refresh what they touch."""
+        if not self.enabled or not pairs:
+            return
+        with self.lock:
+            if self.missed is not None:
+                self.missed.extend(pairs)
+            elif self.built_at is not None:
+                self._add_shows(pairs)
+
+    def _add_shows(self, pairs):
+        # with the lock held
+        new_artists = sorted(set(a for a, v in pairs) - set(self.artist_index))
+        new_venues = sorted(set(v for a, v in pairs) - set(self.venue_index))
+        for id in new_artists:
+            self.artist_index[id] = len(self.artist_index)
+        for id in new_venues:
+            self.venue_index[id] = len(self.venue_index)
+        self.artist_ids = np.concatenate([self.artist_ids, np.array(new_artists, dtype=np.int64)])
+        self.venue_ids = np.concatenate([self.venue_ids, np.array(new_venues, dtype=np.int64)])
+        rows = [self.artist_index[a] for a, v in pairs]
+        cols = [self.venue_index[v] for a, v in pairs]
+        shape = (len(self.artist_ids), len(self.venue_ids))
+        self.matrix.resize(shape)
+        self.matrix = (self.matrix + sparse.csr_matrix(
+            (np.ones(len(pairs)), (rows, cols)), shape=shape)).tocsr()
+        # the similarities of the new shows' artists change, and with them
+        # the lists of every artist sharing a venue with one of them (their
+        # suggested venues come from those artists' venues); likewise for venues
+        artists = set(self.matrix[:, self.matrix[rows].indices].nonzero()[0]) | set(rows)
+        venues = set(self.matrix[self.matrix[:, cols].nonzero()[0]].nonzero()[1]) | set(cols)
+        self.refresh(np.array(sorted(artists), dtype=np.int64),
+                     np.array(sorted(venues), dtype=np.int64))
+
+    # session hooks
+
+    def record(self, session, pairs):
+        """Add (artist_id, venue_id) shows once `session` commits.
+
+        For shows inserted with bulk statements, which skip the flush hook.
+        """
+        if pairs and self.enabled:
+            session.info.setdefault('new_show_pairs', []).extend(pairs)
+
+    def after_flush(self, session, flush_context):
+        self.record(session, [(show.artist_id, show.venue_id) for show in session.new
+                              if isinstance(show, Show)])
+
+    def after_commit(self, session):
+        self.add_shows(session.info.pop('new_show_pairs', None))
+
+    def after_rollback(self, session):
+        session.info.pop('new_show_pairs', None)
+
+    # lookups
+
+    def ensure_built(self):
+        # builds run in the background; the lists stay empty until the first
+        # one is done
+        if self.built_at is not None and time.time() - self.built_at < self.rebuild_after:
+            return
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild_in_background, daemon=True).start()
+
+    def rebuild_in_background(self):
+        try:
+            with self.lock:
+                self.missed = []
+            with self.app.app_context():
+                self.build(self.load_pairs())
+        finally:
+            with self.lock:
+                # after a failed build, apply them to the current lists
+                missed, self.missed = self.missed, None
+                if missed and self.built_at is not None:
+                    self._add_shows(missed)
+            self.rebuilding = False
+
+    def lookup(self, store, id):
+        if not self.enabled:
+            return []
+        self.ensure_built()
+        found = store.get(id)
+        return [] if found is None else found.tolist()
+
+    def for_artist(self, artist_id):
+        """(similar artist ids, suggested venue ids) for an artist page."""
+        return (self.lookup(self.similar_artists, artist_id),
+                self.lookup(self.suggested_venues, artist_id))
+
+    def for_venue(self, venue_id):
+        """(similar venue ids, suggested artist ids) for a venue page."""
+        return (self.lookup(self.similar_venues, venue_id),
+                self.lookup(self.suggested_artists, venue_id))
+
+
+recommender = Recommender()
@@ -0,0 +1,243 @@
+import time
+from datetime import date
+
+import click
+from sqlalchemy import Integer, and_, cast, event, extract, func, inspect, select, union_all
+from sqlalchemy.orm import Session
+
+from models import (db, Venue, Artist, Show, ShowArchive, GenreMonthRollup, VenueMonthRollup,
+                    upsert)
+
+try:
+    import numpy as np
+except ImportError:  # the backfill needs numpy
+    np = None
+
+# Rollup tables behind /analytics.
+#
+# GenreMonthRollup counts shows per artist genre, venue city and month
+# (a show counts once for each of its artist's genres); VenueMonthRollup
+# counts shows per venue and month. Shows inserted, deleted or moved through
+# the ORM update both tables in the same transaction; code that inserts shows
+# with bulk statements calls apply_shows() itself. Archiving does not touch
+# them, the counts cover all shows ever listed. `flask rebuild-rollups`
+# recomputes both tables from scratch.
+
+
+def month_of(value):
+    return date(value.year, value.month, 1)
+
+
+def month_index(column):
+    # year * 12 + month - 1, computed by the database so that the backfill
+    # only has to move integers
+    return (cast(extract('year', column), Integer) * 12
+            + cast(extract('month', column), Integer) - 1)
+
+
+def add_delta(table, keys, delta, conn):
+    # one INSERT ... ON CONFLICT DO UPDATE, so two transactions creating
+    # the same row do not fail each other; rows down to zero are dropped
+    insert = upsert(conn, table).values(show_count=delta, **keys)
+    conn.execute(insert.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={'show_count': table.c.show_count + insert.excluded.show_count}))
+    if delta < 0:
+        criteria = and_(*[table.c[name] == value for name, value in keys.items()])
+        conn.execute(table.delete().where(and_(criteria, table.c.show_count <= 0)))
+
+
+def apply_shows(session, shows, sign=1, conn=None):
+    """Count `(artist_id, venue_id, start_time)` shows in (sign=-1: out)."""
+    shows = [show for show in shows if show[2] is not None]
+    if not shows:
+        return
+    artist_ids = set(show[0] for show in shows)
+    venue_ids = set(show[1] for show in shows)
+    genres = dict(session.query(Artist.id, Artist.genres).filter(
+        Artist.id.in_(artist_ids)).all())
+    places = dict((id, (city, state)) for id, city, state in session.query(
+        Venue.id, Venue.city, Venue.state).filter(Venue.id.in_(venue_ids)).all())
+    by_genre = {}
+    by_venue = {}
+    for artist_id, venue_id, start_time in shows:
+        month = month_of(start_time)
+        key = (venue_id, month)
+        by_venue[key] = by_venue.get(key, 0) + sign
+        city, state = places.get(venue_id, ('', ''))
+        for genre in (genres.get(artist_id) or '').split(','):
+            if genre:
+                key = (genre, city or '', state or '', month)
+                by_genre[key] = by_genre.get(key, 0) + sign
+    conn = conn or session.connection()
+    for (genre, city, state, month), delta in sorted(by_genre.items()):
+        if delta:
+            add_delta(GenreMonthRollup.__table__, {'genre': genre, 'city': city,
+                      'state': state, 'month': month}, delta, conn)
+    for (venue_id, month), delta in sorted(by_venue.items()):
+        if delta:
+            add_delta(VenueMonthRollup.__table__,
+                      {'venue_id': venue_id, 'month': month}, delta, conn)
+
+
+def show_values(show, attrs=('artist_id', 'venue_id', 'start_time')):
+    return tuple(getattr(show, attr) for attr in attrs)
+
+
+def before_flush(session, flush_context, instances):
+    # deleted shows are read before the flush, their rows are gone after it
+    removed = [show_values(obj) for obj in session.deleted if isinstance(obj, Show)]
+    if removed:
+        session.info.setdefault('rollup_removed', []).extend(removed)
+
+
+def after_flush(session, flush_context):
+    added = [show_values(obj) for obj in session.new if isinstance(obj, Show)]
+    removed = session.info.pop('rollup_removed', [])
+    for obj in session.dirty:
+        if isinstance(obj, Show):
+            state = inspect(obj)
+            old = []
+            changed = False
+            for attr in ('artist_id', 'venue_id', 'start_time'):
+                history = state.attrs[attr].history
+                changed = changed or history.has_changes()
+                old.append(history.deleted[0] if history.deleted else getattr(obj, attr))
+            if changed:
+                removed.append(tuple(old))
+                added.append(show_values(obj))
+    if added:
+        apply_shows(session, added, 1)
+    if removed:
+        apply_shows(session, removed, -1)
+
+
+def rebuild(session):
+    """Recompute both rollup tables from every live and archived show.
+
+    Returns the number of shows counted. Grouping is done with numpy on
+    whole columns, so a million shows take a few seconds.
+    """
+    shows = union_all(*[
+        select(model.artist_id, model.venue_id, month_index(model.start_time)).where(
+            model.start_time.isnot(None)) for model in (Show, ShowArchive)])
+    columns = np.array([tuple(row) for row in session.execute(shows).fetchall()],
+                       dtype=np.int64).reshape(-1, 3)
+    conn = session.connection()
+    conn.execute(GenreMonthRollup.__table__.delete())
+    conn.execute(VenueMonthRollup.__table__.delete())
+    if not len(columns):
+        return 0
+    artist_col, venue_col = columns[:, 0], columns[:, 1]
+    month_ids, month_col = np.unique(columns[:, 2], return_inverse=True)
+    month_values = [date(index // 12, index % 12 + 1, 1) for index in month_ids.tolist()]
+
+    # per venue and month
+    venue_ids, venue_col = np.unique(venue_col, return_inverse=True)
+    keys, counts = np.unique(venue_col * len(month_ids) + month_col, return_counts=True)
+    conn.execute(VenueMonthRollup.__table__.insert(), [
+        {'venue_id': int(venue_ids[key // len(month_ids)]),
+         'month': month_values[key % len(month_ids)], 'show_count': int(count)}
+        for key, count in zip(keys.tolist(), counts.tolist())])
+
+    # per genre, city and month: one row per (show, genre of its artist)
+    # every venue and artist rather than an IN list of possibly more ids
+    # than the driver can bind
+    places = dict((id, ((city or ''), (state or ''))) for id, city, state in session.query(
+        Venue.id, Venue.city, Venue.state))
+    place_list = sorted(set(places.values()) | {('', '')})
+    place_index = dict((place, i) for i, place in enumerate(place_list))
+    venue_place = np.array([place_index[places.get(id, ('', ''))] for id in venue_ids.tolist()])
+    artist_ids, artist_col = np.unique(artist_col, return_inverse=True)
+    artist_genres = dict(session.query(Artist.id, Artist.genres))
+    genre_list = []
+    genre_index = {}
+    genre_count = np.zeros(len(artist_ids), dtype=np.int64)
+    genre_flat = []
+    for i, id in enumerate(artist_ids.tolist()):
+        names = [name for name in (artist_genres.get(id) or '').split(',') if name]
+        genre_count[i] = len(names)
+        for name in names:
+            if name not in genre_index:
+                genre_index[name] = len(genre_list)
+                genre_list.append(name)
+            genre_flat.append(genre_index[name])
+    genre_flat = np.array(genre_flat, dtype=np.int64)
+    genre_start = np.concatenate([[0], np.cumsum(genre_count)[:-1]])
+    per_show = genre_count[artist_col]
+    show_of = np.repeat(np.arange(len(columns)), per_show)
+    # position of each expanded row within its show's genre list
+    offset = np.arange(len(show_of)) - np.repeat(np.cumsum(per_show) - per_show, per_show)
+    genre_of = genre_flat[genre_start[artist_col[show_of]] + offset]
+    place_of = venue_place[venue_col[show_of]]
+    keys = (genre_of * len(place_list) + place_of) * len(month_ids) + month_col[show_of]
+    keys, counts = np.unique(keys, return_counts=True)
+    records = []
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        rest, month = divmod(key, len(month_ids))
+        genre, place = divmod(rest, len(place_list))
+        city, state = place_list[place]
+        records.append({'genre': genre_list[genre], 'city': city, 'state': state,
+                        'month': month_values[month], 'show_count': count})
+    if records:
+        conn.execute(GenreMonthRollup.__table__.insert(), records)
+    return len(columns)
+
+
+# queries for /analytics; rows are added up in Python because a sharded
+# session returns one row per shard for each group
+
+def months_ago(count, today=None):
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def genre_months(session, since, city=None, state=None):
+    """{genre: {month: shows}} for shows from `since` on."""
+    query = session.query(GenreMonthRollup.genre, GenreMonthRollup.month,
+                          func.sum(GenreMonthRollup.show_count)).filter(
+        GenreMonthRollup.month >= since)
+    if city:
+        query = query.filter(GenreMonthRollup.city == city)
+    if state:
+        query = query.filter(GenreMonthRollup.state == state)
+    counts = {}
+    for genre, month, shows in query.group_by(GenreMonthRollup.genre, GenreMonthRollup.month):
+        by_month = counts.setdefault(genre, {})
+        by_month[month] = by_month.get(month, 0) + int(shows or 0)
+    return counts
+
+
+def busiest_venues(session, since, city=None, state=None, limit=10):
+    """[(venue id, shows)] of the venues with the most shows from `since` on."""
+    query = session.query(VenueMonthRollup.venue_id, func.sum(VenueMonthRollup.show_count)).filter(
+        VenueMonthRollup.month >= since)
+    if city or state:
+        # venues may sit on other shards than the rollups, so no join
+        venues = session.query(Venue.id)
+        if city:
+            venues = venues.filter(Venue.city == city)
+        if state:
+            venues = venues.filter(Venue.state == state)
+        query = query.filter(VenueMonthRollup.venue_id.in_([id for id, in venues]))
+    counts = {}
+    for venue_id, shows in query.group_by(VenueMonthRollup.venue_id):
+        counts[venue_id] = counts.get(venue_id, 0) + int(shows or 0)
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [item for item in ranked if item[1] > 0][:limit]
+
+
+def init_app(app):
+    event.listen(Session, 'before_flush', before_flush)
+    event.listen(Session, 'after_flush', after_flush)
+
+    @app.cli.command('rebuild-rollups')
+    def rebuild_rollups_command():
+        """Recompute the analytics rollup tables from all shows."""
+        if np is None:
+            raise click.ClickException('Rebuilding the rollups needs numpy.')
+        started = time.perf_counter()
+        counted = rebuild(db.session)
+        db.session.commit()
+        click.echo('Counted %d shows in %.1fs.' % (counted, time.perf_counter() - started))
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from sqlalchemy import create_engine, event, func, inspect, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.schema import Column
+
+from models import db, Venue, Artist, Show, ShowSeries, ShardIdCounter, upsert
+
+# Optional region sharding keyed on `state`.
+#
+# Venues and artists live on the shard of their state, shows on the shard of
+# their venue. Ids are allocated so that `id % number of shards` is the index
+# of the owning shard, which lets a lookup by id (or by a show's venue_id) go
+# straight to one database. Each shard hands out its ids from a counter row
+# per table in "ShardIdCounter", bumped inside the inserting transaction, so
+# two workers never get the same id; the row stays locked until that
+# transaction ends. Queries that cannot be narrowed down go to every
+# shard. A show series lives with its venue too, and so do its shows, so
+# `series_id` routes like `venue_id`. A show may point at an artist from another region, so the artist
+# foreign key is not enforced across shards (SQLite does not enforce it by
+# default).
+
+router = None
+
+
+class ShardRouter(object):
+
+    def __init__(self, shards, states):
+        self.names = list(shards)
+        self.engines = dict((name, create_engine(url)) for name, url in shards.items())
+        self.states = states
+        self.executor = ThreadPoolExecutor(max_workers=len(self.names))
+
+    def shard_for_state(self, state):
+        return self.states.get(state, self.names[0])
+
+    def shard_for_id(self, id):
+        return self.names[int(id) % len(self.names)]
+
+    def next_id(self, connection, table, shard):
+        return self.next_ids(connection, table, shard, 1)[0]
+
+    def next_ids(self, connection, table, shard, count):
+        """`count` unused ids of `table` that map to `shard`."""
+        step = len(self.names)
+        counters = ShardIdCounter.__table__
+        key = counters.c.table_name == table.name
+        bump = counters.update().where(key).values(last_id=counters.c.last_id + count * step)
+        if not connection.execute(bump).rowcount:
+            # first allocation on this shard: start above the rows already there
+            index = self.names.index(shard)
+            top = connection.execute(select(func.max(table.c.id))).scalar() or 0
+            first = top + 1 + (index - top - 1) % step
+            connection.execute(upsert(connection, counters).values(
+                table_name=table.name, last_id=first - step).on_conflict_do_nothing())
+            connection.execute(bump)
+        last = connection.execute(select(counters.c.last_id).where(key)).scalar()
+        return list(range(last - (count - 1) * step, last + 1, step))
+
+    def map(self, fn, *args):
+        """Run `fn(session, *args)` on every shard in parallel.
+
+        Each call gets its own plain session bound to one shard; the results
+        come back in shard order.
+        """
+        def run(name):
+            with Session(bind=self.engines[name]) as session:
+                return fn(session, *args)
+        return list(self.executor.map(run, self.names))
+
+    # ShardedSession hooks
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        if isinstance(instance, (Venue, Artist)):
+            return self.shard_for_state(instance.state)
+        if instance is not None and getattr(instance, 'venue_id', None):
+            return self.shard_for_id(instance.venue_id)
+        return self.names[0]
+
+    def id_chooser(self, query, ident):
+        return [self.shard_for_id(ident[0])]
+
+    def execute_chooser(self, orm_context):
+        clause = getattr(orm_context.statement, 'whereclause', None)
+        if clause is None:
+            return self.names
+        shards = set()
+        for elem in visitors.iterate(clause):
+            if isinstance(elem, BooleanClauseList) and elem.operator is operators.or_:
+                return self.names
+            shard = self._shard_for_comparison(elem)
+            if shard:
+                shards.add(shard)
+        return [name for name in self.names if name in shards] or self.names
+
+    def _shard_for_comparison(self, elem):
+        if not (isinstance(elem, BinaryExpression) and elem.operator is operators.eq):
+            return None
+        column, value = elem.left, elem.right
+        if isinstance(column, BindParameter):
+            column, value = value, column
+        if not (isinstance(column, Column) and isinstance(value, BindParameter)):
+            return None
+        value = value.effective_value
+        if value is None:
+            return None
+        table = column.table.name
+        if column.name == 'state' and table in ('Venue', 'Artist'):
+            return self.shard_for_state(value)
+        if column.name == 'id' and table in ('Venue', 'Artist', 'Show', 'ShowSeries'):
+            return self.shard_for_id(value)
+        if column.name in ('venue_id', 'series_id'):
+            return self.shard_for_id(value)
+        return None
+
+
+def map_shards(fn, *args):
+    """Run `fn(session, *args)` on every shard and chain the results.
+
+    Without sharding this is just `fn(db.session, *args)`.
+    """
+    if router is None:
+        return fn(db.session, *args)
+    return [row for rows in router.map(fn, *args) for row in rows]
+
+
+def assign_id(mapper, connection, target):
+    if target.id is None:
+        shard = inspect(target).identity_token
+        target.id = router.next_id(connection, mapper.local_table, shard)
+
+
+def init_app(app):
+    global router
+    shards = app.config.get('SHARDS')
+    if not shards:
+        return
+    router = ShardRouter(shards, app.config.get('SHARD_STATES', {}))
+    db.session = scoped_session(
+        sessionmaker(class_=ShardedSession, query_cls=db.Query,
+                     shards=router.engines,
+                     shard_chooser=router.shard_chooser,
+                     id_chooser=router.id_chooser,
+                     execute_chooser=router.execute_chooser),
+        scopefunc=db.session.registry.scopefunc)
+    for model in (Venue, Artist, Show, ShowSeries):
+        event.listen(model, 'before_insert', assign_id)
+
+    @app.cli.command('init-shards')
+    def init_shards_command():
+        """Create the tables on every shard."""
+        for name, engine in router.engines.items():
+            db.Model.metadata.create_all(engine)
+            click.echo('Created tables on shard %s.' % name)
@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import request, send_file, session
+from sqlalchemy import func
+
+import sharding
+from changelog import settled_id
+from models import db, Venue, Artist, Show, ShowArchive, ChangeLog
+
+# Static snapshots of the public pages.
+#
+# `flask snapshot` renders the front page, the venue, artist and show
+# listings and every venue and artist page through the app itself and
+# writes them under SNAPSHOT_DIR ("/venues/3" -> venues/3.html), split over
+# a pool of worker processes. The newest settled change log id (see
+# changelog.py) goes to SNAPSHOT_DIR/.changelog_id; the next run only
+# re-renders the pages the changes since then touch, and removes the pages of
+# deleted entities. Changes after that id are read again by the next run, so
+# one that commits late with a lower id is not missed. Pages
+# also change when a show moves from upcoming to past, which the log does
+# not see, so a `--full` run should still happen daily.
+#
+# With SNAPSHOT_SERVE on, GET requests for those pages are answered from the
+# snapshot when the file exists and go to the normal route otherwise.
+
+ENDPOINTS = ('index', 'venues', 'artists', 'shows', 'show_venue', 'show_artist')
+LISTINGS = ('/', '/venues', '/artists', '/shows')
+STATE_FILE = '.changelog_id'
+CHUNK = 50
+# set on the requests that render the snapshot, which must not be served from it
+RENDERING = 'fyyur.snapshot'
+
+app = None
+
+
+def page_file(directory, path):
+    return os.path.join(directory, (path.strip('/') or 'index') + '.html')
+
+
+def write_file(target, data):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = '%s.%d.tmp' % (target, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, target)
+
+
+# rendering, in the worker processes
+
+def init_worker():
+    # a page failing to render is dropped from the snapshot, not fatal
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    # connections inherited from the parent belong to it
+    with app.app_context():
+        engines = sharding.router.engines.values() if sharding.router else [db.engine]
+        for engine in engines:
+            engine.dispose(close=False)
+
+
+def render_pages(directory, paths):
+    """Render `paths` into `directory`; returns (written, removed)."""
+    client = app.test_client()
+    written = removed = 0
+    for path in paths:
+        response = client.get(path, environ_base={RENDERING: True})
+        target = page_file(directory, path)
+        if response.status_code == 200:
+            write_file(target, response.get_data())
+            written += 1
+        elif os.path.exists(target):
+            # the entity is gone
+            os.remove(target)
+            removed += 1
+    return written, removed
+
+
+# what to render
+
+def all_paths():
+    return list(LISTINGS) + ['/venues/%d' % id for id, in db.session.query(Venue.id)] + [
+        '/artists/%d' % id for id, in db.session.query(Artist.id)]
+
+
+def played(column, where, ids):
+    # ids on the other side of the live and archived shows of `ids`
+    found = set()
+    if ids:
+        for model in (Show, ShowArchive):
+            found |= set(id for id, in db.session.query(getattr(model, column)).filter(
+                getattr(model, where).in_(ids)).distinct())
+    return found
+
+
+def affected_paths(changes):
+    """Pages that show something the given ChangeLog rows changed."""
+    paths = set()
+    venue_ids, artist_ids = set(), set()
+    renamed_venues, renamed_artists = set(), set()
+    for change in changes:
+        paths.update(('/venues', '/shows'))
+        if change.kind == 'show':
+            venue_ids.add(change.venue_id)
+            artist_ids.add(change.artist_id)
+        elif change.kind == 'venue':
+            venue_ids.add(change.venue_id)
+            renamed_venues.add(change.venue_id)
+        elif change.kind == 'artist':
+            paths.add('/artists')
+            artist_ids.add(change.artist_id)
+            renamed_artists.add(change.artist_id)
+    # pages listing the shows of a changed venue or artist show its name
+    artist_ids |= played('artist_id', 'venue_id', renamed_venues)
+    venue_ids |= played('venue_id', 'artist_id', renamed_artists)
+    paths.update('/venues/%d' % id for id in venue_ids if id is not None)
+    paths.update('/artists/%d' % id for id in artist_ids if id is not None)
+    return sorted(paths)
+
+
+def read_state(directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def snapshot(directory, workers=None, full=False):
+    """Render the pages into `directory`; returns (rendered, written, removed)."""
+    head = db.session.query(func.max(ChangeLog.id)).scalar() or 0
+    settled = settled_id(db.session, app.config.get('CHANGELOG_SETTLE_SECONDS', 10))
+    since = None if full else read_state(directory)
+    oldest = db.session.query(func.min(ChangeLog.id)).scalar()
+    if since is not None and oldest is not None and oldest > since + 1:
+        since = None  # the log was pruned past the last run
+    if since is None:
+        paths = all_paths()
+    else:
+        paths = affected_paths(ChangeLog.query.filter(
+            ChangeLog.id > since, ChangeLog.id <= head).all())
+    written = removed = 0
+    if paths:
+        chunks = [paths[i:i + CHUNK] for i in range(0, len(paths), CHUNK)]
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_worker) as pool:
+            for done in pool.map(render_pages, [directory] * len(chunks), chunks):
+                written += done[0]
+                removed += done[1]
+    write_file(os.path.join(directory, STATE_FILE), str(max(since or 0, settled)).encode())
+    return len(paths), written, removed
+
+
+# serving
+
+def serve_snapshot():
+    if (request.method != 'GET' or request.endpoint not in ENDPOINTS
+            or request.query_string or request.environ.get(RENDERING)
+            or '_flashes' in session):
+        return None
+    target = page_file(app.config['SNAPSHOT_DIR'], request.path)
+    if not os.path.isfile(target):
+        return None
+    response = send_file(target, mimetype='text/html', max_age=0)
+    response.headers['X-Snapshot'] = 'hit'
+    return response
+
+
+def init_app(flask_app):
+    global app
+    app = flask_app
+    if app.config.get('SNAPSHOT_SERVE'):
+        app.before_request(serve_snapshot)
+
+    @app.cli.command('snapshot')
+    @click.option('--full', is_flag=True, help='Render every page, not only changed ones.')
+    @click.option('--workers', type=int, default=app.config.get('SNAPSHOT_WORKERS'),
+                  help='Rendering processes, one per CPU by default.')
+    def snapshot_command(full, workers):
+        """Render the venue, artist and listing pages to SNAPSHOT_DIR."""
+        started = time.perf_counter()
+        rendered, written, removed = snapshot(app.config['SNAPSHOT_DIR'], workers, full)
+        click.echo('Rendered %d pages (%d written, %d removed) in %.1fs.' % (
+            rendered, written, removed, time.perf_counter() - started))
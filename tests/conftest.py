@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as fyyur_app
+from models import db
+from ratelimit import limiter
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app on a fresh SQLite database, without rate limits."""
+    monkeypatch.setattr(limiter, 'enabled', False)
+    fyyur_app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        SQLALCHEMY_DATABASE_URI='sqlite:///%s' % (tmp_path / 'fyyur.db'))
+    with fyyur_app.app_context():
+        db.create_all()
+    yield fyyur_app
+    with fyyur_app.app_context():
+        db.session.remove()
+        db.get_engine().dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,70 @@
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from images import ImageCache
+from models import db, Venue
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server(tmp_path):
+    """A local stand-in for a remote image host, serving an 800x600 JPEG."""
+    root = tmp_path / 'origin'
+    root.mkdir()
+    Image.new('RGB', (800, 600), 'red').save(str(root / 'venue.jpg'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def venue_id(app, image_server):
+    with app.app_context():
+        venue = Venue(name='The Musical Hop', city='San Francisco', state='CA',
+                      image_link=image_server + '/venue.jpg')
+        db.session.add(venue)
+        db.session.commit()
+        return venue.id
+
+
+def use_cache(app, monkeypatch, tmp_path, **options):
+    cache = ImageCache(str(tmp_path / 'cache'), 10 * 1024 * 1024, 3600, 5, **options)
+    monkeypatch.setitem(app.extensions, 'image_cache', cache)
+    return cache
+
+
+def test_fetches_and_resizes_from_local_server(app, client, venue_id, monkeypatch, tmp_path):
+    use_cache(app, monkeypatch, tmp_path, allow_private=True)
+    response = client.get('/img/venue/%d?w=300' % venue_id)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    # 300 is served from the nearest standard width
+    assert Image.open(BytesIO(response.data)).size == (320, 240)
+    cached = set(path.name.split('.', 1)[1] for path in (tmp_path / 'cache').iterdir())
+    assert cached == {'json', 'src', '320.jpg'}
+
+
+def test_refuses_loopback_by_default(app, client, venue_id, image_server, monkeypatch, tmp_path):
+    use_cache(app, monkeypatch, tmp_path)
+    response = client.get('/img/venue/%d?w=300' % venue_id)
+    # left to the browser, never fetched
+    assert response.status_code == 302
+    assert response.headers['Location'] == image_server + '/venue.jpg'
+    assert not any(name.suffix == '.src' for name in (tmp_path / 'cache').iterdir())
+
+
+def test_allowed_hosts_do_not_lift_the_address_check(app, client, venue_id, monkeypatch, tmp_path):
+    use_cache(app, monkeypatch, tmp_path, allowed_hosts={'127.0.0.1'})
+    assert client.get('/img/venue/%d?w=300' % venue_id).status_code == 302
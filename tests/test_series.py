@@ -0,0 +1,33 @@
+from models import db, Venue, Artist, Show, ShowSeries
+
+
+def add_venue_and_artist(app):
+    with app.app_context():
+        venue = Venue(name='The Musical Hop', city='San Francisco', state='CA', genres='Jazz')
+        artist = Artist(name='Guns N Petals', city='San Francisco', state='CA', genres='Jazz')
+        db.session.add_all([venue, artist])
+        db.session.commit()
+        return venue.id, artist.id
+
+
+def series_form(venue_id, artist_id):
+    return {'venue_id': str(venue_id), 'artist_id': str(artist_id),
+            'start_time': '2035-04-01 20:00', 'repeat': 'weekly', 'count': '3'}
+
+
+def test_series_is_listed(app, client):
+    venue_id, artist_id = add_venue_and_artist(app)
+    response = client.post('/shows/create', data=series_form(venue_id, artist_id))
+    assert b'Series of 3 shows was successfully listed!' in response.data
+    with app.app_context():
+        assert Show.query.filter(Show.series_id.isnot(None)).count() == 3
+
+
+def test_series_with_unknown_artist_is_refused(app, client):
+    venue_id, artist_id = add_venue_and_artist(app)
+    response = client.post('/shows/create', data=series_form(venue_id, 99))
+    assert b'Series could not be listed: no artist with id 99.' in response.data
+    with app.app_context():
+        assert ShowSeries.query.count() == 0
+        assert Show.query.count() == 0
+    assert client.get('/shows').status_code == 200
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+from sqlalchemy import event, text
+
+import sharding
+from models import db, Venue, Artist, Show, ShowSeries
+
+STATES = {'CA': 'west', 'NY': 'east'}
+CITIES = {'CA': 'San Francisco', 'NY': 'New York'}
+NAMES = {'Venue': '%s Hop', 'Artist': '%s Band'}
+
+
+@pytest.fixture
+def sharded(app, tmp_path):
+    """The app on two SQLite shards, CA on "west" and NY on "east"."""
+    session = db.session
+    app.config.update(
+        SHARDS={name: 'sqlite:///%s' % (tmp_path / ('%s.db' % name))
+                for name in ('west', 'east')},
+        SHARD_STATES=STATES)
+    sharding.init_app(app)
+    for engine in sharding.router.engines.values():
+        db.Model.metadata.create_all(engine)
+    yield app
+    with app.app_context():
+        db.session.remove()
+    db.session = session
+    for engine in sharding.router.engines.values():
+        engine.dispose()
+    for model in (Venue, Artist, Show, ShowSeries):
+        event.remove(model, 'before_insert', sharding.assign_id)
+    sharding.router = None
+    app.config.update(SHARDS=None, SHARD_STATES={})
+
+
+def rows_on(shard, table):
+    with sharding.router.engines[shard].connect() as conn:
+        return conn.execute(text('SELECT id, name FROM "%s" ORDER BY id' % table)).fetchall()
+
+
+def add_venues_and_artists(client):
+    for state, city in CITIES.items():
+        form = {'city': city, 'state': state, 'phone': '415-555-0100', 'genres': 'Jazz',
+                'facebook_link': 'https://www.facebook.com/fyyur',
+                'website_link': 'https://fyyur.example.com'}
+        response = client.post('/venues/create', data=dict(
+            form, name=NAMES['Venue'] % state, address='1 Main St'))
+        assert b'was successfully listed!' in response.data
+        response = client.post('/artists/create', data=dict(
+            form, name=NAMES['Artist'] % state))
+        assert b'was successfully listed!' in response.data
+    ids = {}
+    for state in STATES:
+        for table in ('Venue', 'Artist'):
+            (id, name), = rows_on(STATES[state], table)
+            ids[table, state] = id
+    return ids
+
+
+def test_venues_and_artists_live_on_the_shard_of_their_state(sharded, client):
+    ids = add_venues_and_artists(client)
+    names = sharding.router.names
+    for (table, state), id in ids.items():
+        assert rows_on(STATES[state], table) == [(id, NAMES[table] % state)]
+        assert names[id % len(names)] == STATES[state]
+
+
+def test_pages_read_every_shard(sharded, client):
+    ids = add_venues_and_artists(client)
+    # a west artist playing an east venue, and a past show in the west
+    shows = [
+        {'venue_id': ids['Venue', 'NY'], 'artist_id': ids['Artist', 'CA'],
+         'start_time': '2035-01-01 20:00'},
+        {'venue_id': ids['Venue', 'CA'], 'artist_id': ids['Artist', 'CA'],
+         'start_time': '2015-01-01 20:00'},
+        {'venue_id': ids['Venue', 'NY'], 'artist_id': ids['Artist', 'NY'],
+         'start_time': '2035-02-01 20:00'},
+    ]
+    response = client.post('/shows/batch', data=json.dumps(shows),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert json.loads(response.data)['created'] == 3
+    names = sharding.router.names
+    for shard in names:
+        with sharding.router.engines[shard].connect() as conn:
+            for id, venue_id in conn.execute(text('SELECT id, venue_id FROM "Show"')):
+                assert names[venue_id % len(names)] == shard
+                assert names[id % len(names)] == shard
+    with sharding.router.engines['east'].connect() as conn:
+        assert conn.execute(text('SELECT count(*) FROM "Show"')).scalar() == 2
+
+    page = client.get('/venues').data
+    assert b'CA Hop' in page and b'NY Hop' in page
+
+    page = client.post('/venues/search', data={'search_term': 'hop'}).data
+    assert b'CA Hop' in page and b'NY Hop' in page
+
+    page = client.post('/artists/search', data={'search_term': 'band'}).data
+    assert b'CA Band' in page and b'NY Band' in page
+
+    response = client.get('/artists/%d' % ids['Artist', 'CA'])
+    assert response.status_code == 200
+    # one upcoming show on the east shard, one past show on the west shard
+    assert b'NY Hop' in response.data and b'CA Hop' in response.data